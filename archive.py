@@ -0,0 +1,101 @@
+"""Archives of pre-rendered frames, written by bake.py.
+
+An archive is one file: a magic, the length of a json header, the header,
+count + 1 little endian uint64 offsets and then the frames back to back.
+Served archives are memory mapped and frames are sliced out of the mapping
+without copying."""
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+import tempfile
+import threading
+from typing import Dict, List, Mapping, Optional
+
+import numpy as np
+
+MAGIC = b'ASCIIFRM'
+# Bump when the layout changes
+VERSION = 1
+
+LENGTH = struct.Struct('<I')
+
+
+def archive_name(key: str) -> str:
+    return hashlib.sha1(key.encode()).hexdigest()[:16] + '.frames'
+
+
+def write_archive(path: Path, header: Mapping, frames: List[bytes]) -> None:
+    """Writes atomically so that servers never map a partial archive"""
+    path = Path(path)
+    meta = json.dumps(dict(header, version=VERSION, frames=len(frames))).encode()
+    offsets = np.zeros(len(frames) + 1, dtype='<u8')
+    np.cumsum([len(frame) for frame in frames], out=offsets[1:])
+    fd, tmp = tempfile.mkstemp(prefix=path.name, dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + LENGTH.pack(len(meta)) + meta)
+            f.write(offsets.tobytes())
+            for frame in frames:
+                f.write(frame)
+        os.replace(tmp, str(path))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class FrameArchive:
+    """A memory mapped archive, frames are memoryviews into the mapping"""
+    def __init__(self, path: Path):
+        with open(str(path), 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(self._mmap)
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a frame archive'.format(path))
+        start = len(MAGIC) + LENGTH.size
+        length, = LENGTH.unpack(data[len(MAGIC):start])
+        self.header = json.loads(bytes(data[start:start + length]))
+        if self.header.get('version') != VERSION:
+            raise ValueError('{} has version {}, expected {}'.format(path, self.header.get('version'), VERSION))
+        count = self.header['frames']
+        start += length
+        self.offsets = np.frombuffer(data, dtype='<u8', count=count + 1, offset=start).tolist()
+        self._frames = data[start + 8 * (count + 1):]
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def frame(self, i: int) -> memoryview:
+        return self._frames[self.offsets[i]:self.offsets[i + 1]]
+
+
+class ArchiveDirectory:
+    """The archives of a directory by key, mapped on first use. Missing
+    archives are looked for again on every call so new bakes are picked up
+    without restarting."""
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self._archives = {}  # type: Dict[str, FrameArchive]
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[FrameArchive]:
+        with self._lock:
+            archive = self._archives.get(key)
+            if archive is None:
+                path = self.directory / archive_name(key)
+                if not path.is_file():
+                    return None
+                archive = FrameArchive(path)
+                if archive.header.get('key') != key:
+                    return None
+                self._archives[key] = archive
+            return archive
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'archives': len(self._archives),
+                'frames': sum(len(archive) for archive in self._archives.values()),
+            }
@@ -1,11 +1,66 @@
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 
 SIMPLE = b' .:-=+*#%@'
 LONG = b' .\'`^",:;Il!i><~+_-?][}{1)(|\\/tfjrxnuvczXYUJCLQ0OZmwqpdbkhao*#MW&8%B@$'
 
-def shade(buffer: np.array, sequence: str=SIMPLE) -> List[str]:
-    eps = 0.00001
-    lookup = ((buffer - eps) * len(sequence)).astype(np.int)
-    return [bytes(sequence[i] for i in line) for line in lookup]
+EPS = 0.00001
+
+
+class Shader:
+    """Maps float buffers with values in [0, 1] to characters of a ramp in
+    one pass through a lookup table. Writes into a preallocated frame that
+    already holds the newlines, optionally preceded by a header. Values
+    outside [0, 1] are clamped to the ends of the ramp."""
+    def __init__(self, resolution: Tuple[int, int], sequence: bytes = SIMPLE, gamma: float = 1.0, header: bytes = b''):
+        w, h = resolution
+        self.lut = np.frombuffer(sequence, dtype=np.uint8)
+        self.gamma = gamma
+        self.frame = np.empty(len(header) + h * (w + 1), dtype=np.uint8)
+        self.frame[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+        self.lines = self.frame[len(header):].reshape(h, w + 1)
+        self.lines[:, w] = ord('\n')
+        self._index = np.empty((h, w), dtype=np.intp)
+        self._scaled = {}  # scratch buffers per float dtype
+        self._table = None  # character of every uint8 level
+
+    def table(self) -> np.array:
+        """The character of each of the 256 levels of a uint8 buffer"""
+        if self._table is None:
+            levels = np.arange(256) / 255
+            if self.gamma != 1.0:
+                levels = np.power(levels, 1 / self.gamma)
+            index = ((levels - EPS) * len(self.lut)).astype(np.intp)
+            self._table = np.take(self.lut, index, mode='clip')
+        return self._table
+
+    def lookup(self, indices: np.array) -> np.array:
+        """Like shade but for indices into the ramp that were already
+        quantized, e.g. by Renderer.cells"""
+        np.take(self.lut, indices, out=self.lines[:, :-1], mode='clip')
+        return self.lines
+
+    def shade(self, buffer: np.array) -> np.array:
+        """Returns the (h, w + 1) characters of the frame, valid until the next
+        call. Float buffers hold values in [0, 1], uint8 buffers levels 0-255."""
+        if buffer.dtype == np.uint8:
+            np.take(self.table(), buffer, out=self.lines[:, :-1])
+            return self.lines
+        scaled = self._scaled.get(buffer.dtype)
+        if scaled is None:
+            scaled = self._scaled[buffer.dtype] = np.empty(self._index.shape, dtype=buffer.dtype)
+        if self.gamma != 1.0:
+            np.power(buffer, 1 / self.gamma, out=scaled)
+            buffer = scaled
+        np.subtract(buffer, EPS, out=scaled)
+        np.multiply(scaled, len(self.lut), out=scaled)
+        np.copyto(self._index, scaled, casting='unsafe')  # truncates like int()
+        np.take(self.lut, self._index, out=self.lines[:, :-1], mode='clip')
+        return self.lines
+
+
+def shade(buffer: np.array, sequence: bytes = SIMPLE) -> List[bytes]:
+    h, w = buffer.shape
+    lines = Shader((w, h), sequence).shade(buffer)
+    return [line.tobytes() for line in lines[:, :-1]]
@@ -0,0 +1,217 @@
+"""Asyncio (ASGI) server for the ascii endpoints, run with
+
+    uvicorn aserver:app
+
+Streams are paced on the event loop and frames are rendered in an executor,
+with all GL work of the gl backend on the dedicated GL thread. The flask app in server.py
+serves the same endpoints."""
+import asyncio
+import json
+import mimetypes
+from pathlib import Path
+import time
+from typing import Callable, Dict, Iterable, Tuple
+from urllib.parse import parse_qsl
+
+from backends import gl_executor
+from broadcast import AsyncBroadcaster
+from compression import compression_stats, stream_compressor
+from imagecache import cache_headers, image_cache, image_etag, not_modified
+import metrics
+from metrics import ACTIVE_STREAMS, startup
+from pacing import Connection, Pacer
+from stream import (
+    EPOCH, baked, baked_producer, byte_stats, encode_frame, frame_cache, frame_encoder, image_params, pacing_ladder,
+    render_image, stream_params, torus_producer)
+from warmup import warm_worker
+
+
+STATIC = Path(__file__).parent / 'static'
+
+broadcaster = AsyncBroadcaster(EPOCH)
+
+
+async def respond(
+        send: Callable, status: int, body: bytes, content_type: str, headers: Iterable[Tuple[str, str]] = ()) -> None:
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode())] + [
+            (name.lower().encode(), value.encode()) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def bad_request(send: Callable, e: ValueError) -> None:
+    await respond(send, 400, '{}\n'.format(e).encode(), 'text/plain')
+
+
+async def static_file(send: Callable, name: str) -> None:
+    path = STATIC / name
+    # only serve files directly in the static folder
+    if path.parent != STATIC or not path.is_file():
+        await respond(send, 404, b'not found', 'text/plain')
+        return
+    content_type, _ = mimetypes.guess_type(name)
+    await respond(send, 200, path.read_bytes(), content_type or 'application/octet-stream')
+
+
+async def torus_image(send: Callable, headers: Dict[str, str], args: Dict[str, str]) -> None:
+    try:
+        params = image_params(args)
+    except ValueError as e:
+        await bad_request(send, e)
+        return
+    etag = image_etag(params)
+    if not_modified(headers.get('if-none-match', ''), etag):
+        image_cache.count_not_modified()
+        await respond(send, 304, b'', 'image/png', cache_headers(etag))
+        return
+    loop = asyncio.get_event_loop()
+    png = await loop.run_in_executor(None, image_cache.get_or_render, etag, lambda: render_image(*params))
+    startup.frame_sent()
+    await respond(send, 200, png, 'image/png', cache_headers(etag))
+
+
+def async_producer(params):
+    baked = baked_producer(params)
+    if baked is not None:
+        # slicing the archive is cheaper than a trip through the executor
+        async def read(frame: int) -> memoryview:
+            return baked(frame)
+        return read
+
+    produce = torus_producer(params)
+
+    async def render(frame: int) -> bytes:
+        return await asyncio.get_event_loop().run_in_executor(None, produce, frame)
+    return render
+
+
+async def disconnected(receive: Callable) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream_torus(receive: Callable, send: Callable, headers: Dict[str, str], args: Dict[str, str]) -> None:
+    if 'curl' not in headers.get('user-agent', 'unknown') and 'curl' not in args.get('user-agent', 'unknown'):
+        await static_file(send, 'ubuntu.html')
+        return
+
+    try:
+        ladder = pacing_ladder(stream_params(args), args)
+    except ValueError as e:
+        await bad_request(send, e)
+        return
+    encoder = frame_encoder(args)
+    compressor = stream_compressor(headers.get('accept-encoding', ''))
+    response_headers = [(b'content-type', b'text/plain;charset=UTF-8'), (b'vary', b'Accept-Encoding')]
+    if compressor is not None:
+        response_headers.append((b'content-encoding', compressor.encoding.encode()))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+
+    connection = Connection.from_asgi(send)
+
+    async def frames():
+        with Pacer(ladder) as pacer:
+            changed = True
+            while changed:
+                changed = False
+                params = pacer.params
+                with broadcaster.subscribe(params, params.fps, lambda: async_producer(params)) as subscription:
+                    async for frame in subscription:
+                        data = encode_frame(encoder, frame, compressor)
+                        # send waits while the client does not drain the connection
+                        start = time.perf_counter()
+                        await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+                        if pacer.record(len(data), time.perf_counter() - start, connection.unsent()):
+                            changed = True
+                            break
+        await send({'type': 'http.response.body', 'body': compressor.finish() if compressor else b''})
+
+    # the server silently drops writes to closed connections, so the stream
+    # has to be stopped when the client goes away
+    tasks = [asyncio.ensure_future(frames()), asyncio.ensure_future(disconnected(receive))]
+    ACTIVE_STREAMS.inc()
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        ACTIVE_STREAMS.dec()
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()
+
+
+async def stats(send: Callable) -> None:
+    body = json.dumps({
+        'frame_cache': frame_cache.stats(),
+        'baked': baked.stats(),
+        'broadcast': broadcaster.stats(),
+        'bytes': {mode: s.stats() for mode, s in byte_stats.items()},
+        'compression': {encoding: s.stats() for encoding, s in compression_stats.items()},
+        'images': image_cache.stats(),
+        'startup': startup.stats(),
+    })
+    await respond(send, 200, body.encode(), 'application/json')
+
+
+async def profile(send: Callable, args: Dict[str, str]) -> None:
+    """Sampled stacks of this worker, only with PROFILING=1"""
+    if not metrics.PROFILING:
+        await respond(send, 404, b'not found', 'text/plain')
+        return
+    try:
+        seconds = min(float(args.get('seconds', 10)), 60)
+    except ValueError as e:
+        await bad_request(send, e)
+        return
+    stacks = await asyncio.get_event_loop().run_in_executor(None, metrics.profile, seconds)
+    if stacks is None:
+        await respond(send, 409, b'already profiling\n', 'text/plain')
+        return
+    await respond(send, 200, stacks.encode(), 'text/plain')
+
+
+def decode_headers(headers: Iterable[Tuple[bytes, bytes]]) -> Dict[str, str]:
+    return {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in headers}
+
+
+async def lifespan(receive: Callable, send: Callable) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # uvicorn accepts connections once startup is complete
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, warm_worker)
+            except Exception as e:  # pylint: disable=broad-except
+                await send({'type': 'lifespan.startup.failed', 'message': 'warm-up failed: {!r}'.format(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            gl_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope: Dict, receive: Callable, send: Callable) -> None:
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    path = scope['path']
+    args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+    if path == '/torus':
+        await stream_torus(receive, send, decode_headers(scope['headers']), args)
+    elif path == '/torus.png':
+        await torus_image(send, decode_headers(scope['headers']), args)
+    elif path == '/stats':
+        await stats(send)
+    elif path == '/metrics':
+        await respond(send, 200, metrics.exposition(), metrics.CONTENT_TYPE)
+    elif path == '/profile':
+        await profile(send, args)
+    elif path.startswith('/static/'):
+        await static_file(send, path[len('/static/'):])
+    else:
+        await respond(send, 404, b'not found', 'text/plain')
@@ -0,0 +1,202 @@
+"""Rendering backends. Both produce renderers with the interface of
+renderer.Renderer: render(camera, light1), luminance(), luminance_batch(),
+cells(), snapshot() and snapshot2().
+
+The gl backend renders with moderngl on a dedicated thread. The numpy
+backend renders with pygl on the calling thread and needs no GL or X
+libraries. moderngl is only imported when the gl backend is used and pygl
+only when the numpy backend is."""
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+import ascii
+from lod import lod_chain
+from mesh import Mesh, normalized
+from metrics import GL_CONTEXTS, STAGE_SECONDS
+
+Size = Tuple[int, int]
+
+BACKENDS = ('gl', 'numpy')
+DEFAULT_BACKEND = os.environ.get('BACKEND', 'gl')
+# Mesa keeps compiled shaders in this directory, keep it across restarts,
+# e.g. on a volume, to skip compiling. Empty leaves the driver default.
+SHADER_CACHE = os.environ.get('SHADER_CACHE', '')
+
+# The GL context is only ever made current on this thread
+gl_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gl')
+
+
+def create_context():
+    # Re-use context objects as a workaround for this issue
+    # https://github.com/moderngl/moderngl/issues/226
+    if create_context.cache:
+        return create_context.cache
+
+    if SHADER_CACHE:
+        # read by the driver when the context is created
+        os.makedirs(SHADER_CACHE, exist_ok=True)
+        os.environ.setdefault('MESA_SHADER_CACHE_DIR', os.path.abspath(SHADER_CACHE))
+    import moderngl
+    ctx = moderngl.create_standalone_context(
+        libgl='libGL.so.1',
+        libx11='libX11.so.6')
+    ctx.enable(moderngl.DEPTH_TEST | moderngl.CULL_FACE | moderngl.BLEND)
+    GL_CONTEXTS.inc()
+    create_context.cache = ctx
+    return ctx
+create_context.cache = None  # type: ignore[attr-defined]
+
+
+def resource_pool():
+    """GL resources of the shared context, only use on the GL thread"""
+    if resource_pool.cache is None:
+        from renderer import ResourcePool
+        resource_pool.cache = ResourcePool(create_context())
+    return resource_pool.cache
+resource_pool.cache = None  # type: ignore[attr-defined]
+
+
+def run_gl(fn: Callable, *args):
+    """Runs fn on the GL thread and waits for the result"""
+    return gl_executor.submit(fn, *args).result()
+
+
+class VertexShader:
+    """NumPy port of shaders/simple.vert. Writes into buffers that are reused
+    by the next call, use one per program."""
+    def __init__(self):
+        from pygl import VertexStage
+        self.stage = VertexStage()
+
+    def __call__(self, positions_in, normals_in, uniforms):
+        # The matrices are laid out the way GL reads them, transposed compared
+        # to numgl, which multiplies column vectors
+        projection = np.asarray(uniforms['u_projection']).T
+        model_view = np.asarray(uniforms['u_modelView']).T
+        positions = self.stage.positions(projection @ model_view, positions_in)
+        light = normalized(np.asarray(uniforms['u_light1'], dtype=positions.dtype))
+        gray = self.stage.lambert(model_view, normals_in, light, uniforms['u_ambient'])
+        return positions, {'gray': gray}
+
+
+def fragment_shader(inputs):
+    return inputs['gray']
+
+
+class NumpyRenderer:
+    """Renders with pygl in float32 into a gray buffer"""
+    def __init__(self, size: Size, mesh: Mesh, projection: np.array, lod: bool = True):
+        from pygl import Program
+        w, h = size
+        self.size = size
+        self.mesh = mesh
+        self.projection = projection
+        self.lods = lod_chain(mesh) if lod else None
+        self.target = np.zeros((h, w), dtype='f4')
+        self.scaled = np.empty((h, w), dtype='f4')
+        self.gray = np.empty((h, w), dtype=np.uint8)
+        self.z_buffer = np.empty((h, w), dtype='f4')
+        self.program = Program(vertex_shader=VertexShader(), fragment_shader=fragment_shader, dtype='f4')
+        self.oversampled = {}  # type: Dict[int, NumpyRenderer]
+
+    def level(self, camera: np.array) -> Mesh:
+        """The mesh to draw, simplified when it covers few pixels"""
+        if self.lods is None:
+            return self.mesh
+        return self.lods.select(self.projection, camera, self.size)
+
+    def render(self, camera: np.array, light1: np.array):
+        self.target.fill(0)
+        self.program.render(
+            self.target, self.z_buffer, self.level(camera),
+            u_projection=self.projection, u_modelView=camera, u_light1=light1, u_ambient=0.01)
+
+    def luminance(self, camera: np.array, light1: np.array, prefetch=None) -> np.array:
+        """Renders and returns the target as uint8, prefetch is ignored since
+        there is no readback to overlap"""
+        with STAGE_SECONDS.labels('draw').time():
+            self.render(camera, light1)
+        np.multiply(self.target, 255, out=self.scaled)
+        np.rint(self.scaled, out=self.scaled)
+        np.copyto(self.gray, self.scaled, casting='unsafe')
+        return self.gray
+
+    def luminance_batch(self, cameras: List[np.array], light1: np.array) -> np.array:
+        """Renders one frame per camera, there is no per frame overhead to
+        amortize so they are rendered one at a time"""
+        return np.array([self.luminance(camera, light1).copy() for camera in cameras])
+
+    def cells(self, camera: np.array, light1: np.array, levels: int, gamma: float = 1.0, oversample: int = 4, prefetch=None) -> np.array:
+        """Renders oversampled and returns the ramp index of every pixel,
+        averaged the same way as shaders/quantize.frag"""
+        w, h = self.size
+        if oversample not in self.oversampled:
+            self.oversampled[oversample] = NumpyRenderer(
+                (w * oversample, h * oversample), self.mesh, self.projection, lod=self.lods is not None)
+        oversampled = self.oversampled[oversample]
+        with STAGE_SECONDS.labels('draw').time():
+            oversampled.render(camera, light1)
+        gray = oversampled.target.reshape(h, oversample, w, oversample).mean(axis=(1, 3))
+        index = ((np.power(gray, 1 / gamma) - ascii.EPS) * levels).astype(np.intp)
+        np.clip(index, 0, levels - 1, out=index)
+        np.copyto(self.gray, index, casting='unsafe')
+        return self.gray
+
+    def snapshot(self):
+        """Returns the target as an image"""
+        from PIL import Image
+        return Image.fromarray((self.target * 255).round().astype(np.uint8)).convert('RGB')
+
+    def snapshot2(self) -> np.array:
+        """Returns the target as an RGB ndarray"""
+        h, w = self.target.shape
+        return np.broadcast_to(self.target[:, :, None], (h, w, 3))
+
+
+class GLBackend:
+    name = 'gl'
+
+    def run(self, fn: Callable, *args):
+        """Runs fn with the context current on the GL thread"""
+        def current():
+            with create_context():
+                return fn(*args)
+        return run_gl(current)
+
+    def compile_programs(self) -> None:
+        """Compiles all programs of renderer.Renderer"""
+        def compile_all():
+            from renderer import PROGRAMS
+            pool = resource_pool()
+            for shaders in PROGRAMS:
+                pool.program(*shaders)
+        self.run(compile_all)
+
+    def renderer(self, size: Size, mesh: Mesh, projection: np.array):
+        """Only call from within run()"""
+        from renderer import Renderer
+        return Renderer(create_context(), size, mesh, projection=projection, pool=resource_pool())
+
+
+class NumpyBackend:
+    name = 'numpy'
+
+    def run(self, fn: Callable, *args):
+        return fn(*args)
+
+    def compile_programs(self) -> None:
+        """The shaders are python, there is nothing to compile"""
+
+    def renderer(self, size: Size, mesh: Mesh, projection: np.array) -> NumpyRenderer:
+        return NumpyRenderer(size, mesh, projection)
+
+
+def get_backend(name: str = DEFAULT_BACKEND):
+    if name == 'gl':
+        return GLBackend()
+    if name == 'numpy':
+        return NumpyBackend()
+    raise ValueError('unknown backend {}, expected one of {}'.format(name, ', '.join(BACKENDS)))
@@ -0,0 +1,56 @@
+"""Renders a looping stream into a frame archive that the servers map and
+serve instead of rendering, for the same query parameters as /torus
+
+    python bake.py 'resolution=80x24&ramp=long'
+
+Frame n of a stream is frame n modulo the loop length of the archive."""
+import argparse
+from pathlib import Path
+import time
+from urllib.parse import parse_qsl
+
+from archive import archive_name, write_archive
+from backends import get_backend
+from stream import (
+    LOOP_SECONDS, TORUS, StreamParams, bake_key, baked, render_frames, stream_params, stream_projection,
+    stream_shader)
+
+# Frames rendered per batch
+BATCH = 64
+
+
+def bake(params: StreamParams, frames: int, directory: Path) -> Path:
+    backend = get_backend(params.backend)
+    shader = stream_shader(params)
+
+    def render():
+        renderer = backend.renderer(params.resolution, TORUS, stream_projection(params))
+        rendered = []
+        for start in range(0, frames, BATCH):
+            rendered.extend(render_frames(renderer, shader, params, range(start, min(start + BATCH, frames))))
+        return rendered
+
+    key = bake_key(params)
+    path = directory / archive_name(key)
+    write_archive(path, {'key': key, 'fps': params.fps, 'resolution': list(params.resolution)}, backend.run(render))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('query', nargs='?', default='', help='stream parameters, e.g. resolution=80x24&fps=25')
+    parser.add_argument('--seconds', type=float, default=LOOP_SECONDS, help='length of the loop')
+    parser.add_argument('--output', type=Path, default=baked.directory, help='archive directory')
+    args = parser.parse_args()
+
+    params = stream_params(dict(parse_qsl(args.query)))
+    frames = max(round(args.seconds * params.fps), 1)
+    args.output.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    path = bake(params, frames, args.output)
+    print('{} frames, {} bytes in {:.1f}s: {}'.format(
+        frames, path.stat().st_size, time.perf_counter() - start, path))
+
+
+if __name__ == '__main__':
+    main()
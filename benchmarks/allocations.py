@@ -0,0 +1,84 @@
+"""Measures the memory cost of pygl frames, run from the repository root with
+
+    python -m benchmarks.allocations
+
+Renders the torus with float64 and float32 programs, once reusing the
+scratch arena of the program from frame to frame and once with a new arena
+every frame, which allocates every intermediate array like pygl used to.
+Reports the time per frame, the peak of memory allocated within a frame, the
+minor page faults per frame, which count memory touched for the first time,
+and the garbage collections per 100 frames.
+"""
+import gc
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+from pyrr import Matrix44
+
+from backends import VertexShader, fragment_shader
+from pygl import Arena, Program
+from torus import torus
+
+RESOLUTIONS = [(80, 24), (320, 96), (640, 400)]
+FRAMES = 50
+
+
+def collections() -> int:
+    return sum(generation['collections'] for generation in gc.get_stats())
+
+
+def run(program: Program, size, mesh, fresh: bool, trace: bool):
+    w, h = size
+    target = np.zeros((h, w), dtype=program.dtype or np.float64)
+    z_buffer = np.empty((h, w), dtype=target.dtype)
+    projection = Matrix44.perspective_projection(60, w / h, 0.1, 10.0)
+    light1 = np.array([0, 1, 1]) / np.sqrt(2)
+
+    def frame(i):
+        if fresh:
+            program.arena = Arena()
+            program.vertex_shader.stage.arena = Arena()
+        camera = Matrix44.from_translation(np.array([0, 0, -3])) * Matrix44.from_eulers(i * np.array([0.17, 0.2, 0]))
+        target.fill(0)
+        program.render(target, z_buffer, mesh, u_projection=projection, u_modelView=camera, u_light1=light1, u_ambient=0.01)
+
+    # warm up, the arena grows to the largest frame
+    for i in range(5):
+        frame(i)
+    peak = 0
+    gcs = collections()
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start = time.perf_counter()
+    for i in range(FRAMES):
+        if trace:
+            # starting clears the traces and the peak, reset_peak() needs 3.9
+            tracemalloc.start()
+        frame(i)
+        if trace:
+            _, high = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            peak = max(peak, high)
+    seconds = (time.perf_counter() - start) / FRAMES
+    faults = (resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults) / FRAMES
+    return seconds, peak, faults, (collections() - gcs) * 100 / FRAMES
+
+
+def main():
+    mesh = torus(1, 0.5, 48, 128)
+    print('{:>10} {:>8} {:>6} {:>10} {:>10} {:>12} {:>8} {:>10}'.format(
+        'resolution', 'dtype', 'arena', 'ms/frame', 'peak KiB', 'faults/frame', 'gc/100', 'arena KiB'))
+    for size in RESOLUTIONS:
+        for dtype in (np.float64, np.float32):
+            for fresh in (True, False):
+                program = Program(VertexShader(), fragment_shader, dtype=dtype)
+                seconds, _, faults, gcs = run(program, size, mesh, fresh, trace=False)
+                _, peak, _, _ = run(program, size, mesh, fresh, trace=True)
+                print('{:>10} {:>8} {:>6} {:>10.2f} {:>10.0f} {:>12.0f} {:>8.0f} {:>10.0f}'.format(
+                    '{}x{}'.format(*size), np.dtype(dtype).name, 'new' if fresh else 'reused', seconds * 1e3,
+                    peak / 1024, faults, gcs, (program.arena.nbytes + program.vertex_shader.stage.arena.nbytes) / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""Compares the frame rate of the rendering backends for a few terminal
+sizes, run from the repository root with
+
+    python -m benchmarks.backends
+"""
+import time
+
+from backends import BACKENDS
+from stream import StreamParams, torus_producer
+
+RESOLUTIONS = [(80, 24), (160, 48), (320, 96)]
+FRAMES = 50
+
+
+def fps(backend: str, resolution) -> float:
+    produce = torus_producer(StreamParams(resolution, 0.5, 25, 60, 3.2, backend=backend))
+    produce(0)  # creates the renderer
+    start = time.perf_counter()
+    # distinct frames so that the frame cache never hits
+    for frame in range(1, FRAMES + 1):
+        produce(frame)
+    return FRAMES / (time.perf_counter() - start)
+
+
+def main():
+    print('{:>10}'.format('resolution') + ''.join('{:>10}'.format(name) for name in BACKENDS))
+    for w, h in RESOLUTIONS:
+        rates = [fps(name, (w, h)) for name in BACKENDS]
+        print('{:>10}'.format('{}x{}'.format(w, h)) + ''.join('{:>6.0f}fps'.format(r) for r in rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Measures the CPU cost of /torus.png requests, run from the repository root
+with
+
+    python -m benchmarks.images
+
+Times rendering and encoding with each encoder profile, a request served
+from the image cache and a request answered with 304 Not Modified, in CPU
+milliseconds per request.
+"""
+import argparse
+import time
+
+from backends import BACKENDS, DEFAULT_BACKEND
+from imagecache import ImageCache, image_etag, not_modified
+from stream import IMAGE_PROFILES, image_params, render_image
+
+RESOLUTIONS = ['80x50', '320x200', '640x400']
+REQUESTS = 50
+
+
+def cpu_ms(fn, requests: int = REQUESTS) -> float:
+    start = time.process_time()
+    for _ in range(requests):
+        fn()
+    return (time.process_time() - start) / requests * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND)
+    args = parser.parse_args()
+    print('{:>10} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'resolution', 'profile', 'bytes', 'render ms', 'cached ms', '304 ms'))
+    for resolution in RESOLUTIONS:
+        for profile in IMAGE_PROFILES:
+            params = image_params({'resolution': resolution, 't': '1', 'backend': args.backend, 'profile': profile})
+            cache = ImageCache()
+            png = render_image(*params)
+            rendered = cpu_ms(lambda: render_image(*params), 10)
+
+            def cached():
+                cache.get_or_render(image_etag(image_params(
+                    {'resolution': resolution, 't': '1', 'backend': args.backend, 'profile': profile})), lambda: png)
+
+            def revalidated():
+                etag = image_etag(image_params(
+                    {'resolution': resolution, 't': '1', 'backend': args.backend, 'profile': profile}))
+                assert not_modified('"{}"'.format(etag), etag)
+            print('{:>10} {:>8} {:>10} {:>10.2f} {:>10.3f} {:>10.3f}'.format(
+                resolution, profile, len(png), rendered, cpu_ms(cached), cpu_ms(revalidated)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""Times mesh preprocessing for increasingly large meshes, run from the
+repository root with
+
+    python -m benchmarks.mesh_preprocess
+"""
+import time
+
+from mesh import Mesh
+from renderer import pack
+from torus import torus
+
+# (a, b) torus subdivisions giving 2 * a * b faces
+SIZES = [(50, 100), (100, 500), (500, 1000)]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    print('{:>10} {:>16} {:>10}'.format('faces', 'vertex normals', 'pack'))
+    for a, b in SIZES:
+        generated = torus(1, 0.5, a, b)
+        mesh = Mesh(generated.vertices, generated.faces)
+        _, normals = timed(mesh.compute_vertex_normals)
+        _, packing = timed(pack, mesh)
+        print('{:>10} {:>14.1f}ms {:>8.1f}ms'.format(len(mesh.faces), normals * 1e3, packing * 1e3))
+
+
+if __name__ == '__main__':
+    main()
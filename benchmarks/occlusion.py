@@ -0,0 +1,71 @@
+"""Measures overdraw of pygl with and without occlusion culling, run from the
+repository root with
+
+    python -m benchmarks.occlusion
+
+Renders the torus alone and a stack of tori one behind the other. Reports
+the time per frame, the fragments depth tested per covered pixel and the
+share of triangles and (triangle, tile) pairs that were skipped as hidden.
+"""
+import time
+
+import numpy as np
+from pyrr import Matrix44
+
+from backends import VertexShader, fragment_shader
+from mesh import Mesh
+from pygl import Program
+from torus import torus
+
+RESOLUTIONS = [(80, 24), (320, 96), (640, 400)]
+FRAMES = 20
+
+
+def stack(mesh: Mesh, count: int, spacing: float) -> Mesh:
+    """count copies of mesh, each spacing farther away than the previous"""
+    vertices = np.asarray(mesh.vertices)
+    faces = np.asarray(mesh.faces)
+    return Mesh(
+        np.concatenate([vertices - [0, 0, i * spacing] for i in range(count)]),
+        np.concatenate([faces + i * len(vertices) for i in range(count)]),
+        vertex_normals=np.concatenate([mesh.vertex_normals] * count))
+
+
+def run(program: Program, size, mesh: Mesh):
+    w, h = size
+    target = np.zeros((h, w), dtype=np.float32)
+    z_buffer = np.empty((h, w), dtype=np.float32)
+    projection = Matrix44.perspective_projection(60, w / h, 0.1, 20.0)
+    light1 = np.array([0, 1, 1]) / np.sqrt(2)
+    totals = {}
+    covered = 0
+    start = time.perf_counter()
+    for i in range(FRAMES):
+        camera = Matrix44.from_translation(np.array([0, 0, -3])) * Matrix44.from_eulers(i * np.array([0.07, 0.1, 0]))
+        target.fill(0)
+        program.render(target, z_buffer, mesh, u_projection=projection, u_modelView=camera, u_light1=light1, u_ambient=0.01)
+        for name, count in program.counts.items():
+            totals[name] = totals.get(name, 0) + count
+        covered += np.count_nonzero(np.isfinite(z_buffer))
+    return (time.perf_counter() - start) / FRAMES, totals, covered
+
+
+def main():
+    single = torus(1, 0.5, 48, 128)
+    meshes = [('torus', single), ('8 tori', stack(single, 8, 1.2))]
+    print('{:>10} {:>8} {:>10} {:>10} {:>14} {:>10} {:>10}'.format(
+        'resolution', 'mesh', 'occlusion', 'ms/frame', 'fragments/px', 'tris hid', 'pairs hid'))
+    for size in RESOLUTIONS:
+        for name, mesh in meshes:
+            for occlusion in (False, True):
+                program = Program(VertexShader(), fragment_shader, dtype=np.float32, occlusion=occlusion)
+                seconds, totals, covered = run(program, size, mesh)
+                print('{:>10} {:>8} {:>10} {:>10.2f} {:>14.2f} {:>9.0f}% {:>9.0f}%'.format(
+                    '{}x{}'.format(*size), name, 'on' if occlusion else 'off', seconds * 1e3,
+                    totals['fragments'] / max(covered, 1),
+                    100 * totals['hidden_triangles'] / max(totals['triangles'], 1),
+                    100 * totals['hidden_pairs'] / max(totals['pairs'], 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Times pygl rendering of the torus with an increasing number of worker
+processes, run from the repository root with
+
+    python -m benchmarks.parallel
+"""
+import os
+import time
+
+import numpy as np
+from pyrr import Matrix44
+
+from backends import VertexShader, fragment_shader
+from parallel import ParallelProgram
+from pygl import Program
+from torus import torus
+
+RESOLUTIONS = [(320, 200), (640, 400), (1280, 800)]
+FRAMES = 20
+
+
+def frame_time(program, target: np.array, z_buffer: np.array, mesh, projection) -> float:
+    light1 = np.array([0, 1, 1]) / np.sqrt(2)
+    start = time.perf_counter()
+    for frame in range(FRAMES):
+        camera = Matrix44.from_translation(np.array([0, 0, -3])) * Matrix44.from_eulers(frame * np.array([0.17, 0.2, 0]))
+        program.render(target, z_buffer, mesh, u_projection=projection, u_modelView=camera, u_light1=light1, u_ambient=0.01)
+    return (time.perf_counter() - start) / FRAMES
+
+
+def main():
+    mesh = torus(1, 0.5, 48, 128)
+    workers = [n for n in (2, 4, 8, 16) if n <= (os.cpu_count() or 1)]
+    print('{:>10} {:>10}'.format('resolution', 'single') + ''.join('{:>10}'.format('{} procs'.format(n)) for n in workers))
+    for w, h in RESOLUTIONS:
+        projection = Matrix44.perspective_projection(60, w / h, 0.1, 10.0)
+        times = [frame_time(Program(VertexShader(), fragment_shader), np.zeros((h, w)), np.empty((h, w)), mesh, projection)]
+        for n in workers:
+            with ParallelProgram(VertexShader(), fragment_shader, workers=n) as program:
+                times.append(frame_time(program, program.buffer((h, w)), program.buffer((h, w)), mesh, projection))
+        print('{:>10}'.format('{}x{}'.format(w, h)) + ''.join('{:>8.1f}ms'.format(t * 1e3) for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""Times every stage of the frame pipeline for both backends over a matrix
+of resolutions, meshes and ramps, run from the repository root with
+
+    python -m benchmarks.pipeline --output results.json
+
+Results are JSON with the median time of each stage, frames per second of
+the full stream path, the frames per second the stages add up to and the
+peak memory allocated by one frame. Compare
+against a stored run with
+
+    python -m benchmarks.pipeline --save-baseline benchmarks/baseline.json
+    python -m benchmarks.pipeline --baseline benchmarks/baseline.json
+
+which exits with status 1 if any case got slower than the tolerance.
+"""
+import argparse
+import json
+from pathlib import Path
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from pyrr import Matrix44
+
+import ascii
+from backends import create_context, get_backend
+from delta import CLEAR
+from mesh_io import load_obj
+from pygl import draw_triangles
+from stream import StreamParams, finish_frame, render_frame, scene
+from torus import torus
+
+RESOLUTIONS = [(80, 24), (160, 48), (320, 96)]
+TORUS_SIZES = [(8, 8), (32, 32), (128, 128), (256, 256)]
+RAMPS = {'simple': ascii.SIMPLE, 'long': ascii.LONG}
+MESHES = Path(__file__).parent.parent / 'meshes'
+
+
+def meshes(quick: bool):
+    sizes = TORUS_SIZES[:2] if quick else TORUS_SIZES
+    for a, b in sizes:
+        yield 'torus{}x{}'.format(a, b), torus(1, 0.5, a, b)
+    for path in sorted(MESHES.glob('*.obj')):
+        yield path.name, load_obj(path)
+
+
+def timed(fn: Callable, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def scenes(params: StreamParams, t: float):
+    """The scene of this and of the next frame, render_frame() computes both"""
+    return scene(params, t), scene(params, t + 1 / params.fps)
+
+
+def numpy_stages(renderer, shader: ascii.Shader, params: StreamParams, t: float) -> Dict[str, float]:
+    """The camera and light, the steps of luminance() on the level of detail
+    it draws: vertex shading with face classification, rasterization and the
+    conversion to uint8, then ascii shading and the scroller overlay"""
+    ((camera, light1), _), cameras = timed(scenes, params, t)
+    uniforms = dict(u_projection=renderer.projection, u_modelView=camera, u_light1=light1, u_ambient=0.01)
+    program = renderer.program
+    (screen, varying), vertex = timed(
+        lambda: program.primitives(params.resolution, renderer.level(camera), uniforms))
+
+    def raster():
+        renderer.target.fill(0)
+        renderer.z_buffer.fill(np.inf)
+        draw_triangles(
+            renderer.target, renderer.z_buffer, screen, program.fragment_shader, varying, program.tile_size,
+            arena=program.arena, occlusion=program.occlusion)
+    _, rasterize = timed(raster)
+
+    def convert():
+        np.multiply(renderer.target, 255, out=renderer.scaled)
+        np.rint(renderer.scaled, out=renderer.scaled)
+        np.copyto(renderer.gray, renderer.scaled, casting='unsafe')
+        return renderer.gray
+    gray, conversion = timed(convert)
+    lines, shade = timed(shader.shade, gray)
+    _, overlay = timed(finish_frame, shader, lines, params, t)
+    return {
+        'scene': cameras, 'vertex': vertex, 'raster': rasterize, 'convert': conversion, 'shade': shade,
+        'overlay': overlay}
+
+
+def gl_stages(renderer, shader: ascii.Shader, params: StreamParams, t: float) -> Dict[str, float]:
+    """The camera and light, luminance() or cells() the way render_frame()
+    calls them, drawing the next frame while this one is read back, then
+    ascii shading and the scroller overlay"""
+    ((camera, light1), prefetch), cameras = timed(scenes, params, t)
+    if params.oversample > 1:
+        indices, render = timed(lambda: renderer.cells(
+            camera, light1, len(params.ramp), params.gamma, params.oversample, prefetch=prefetch))
+        lines, shade = timed(shader.lookup, indices)
+    else:
+        gray, render = timed(lambda: renderer.luminance(camera, light1, prefetch=prefetch))
+        lines, shade = timed(shader.shade, gray)
+    _, overlay = timed(finish_frame, shader, lines, params, t)
+    return {'scene': cameras, 'render': render, 'shade': shade, 'overlay': overlay}
+
+
+STAGES = {'numpy': numpy_stages, 'gl': gl_stages}
+
+
+def run_case(backend_name: str, resolution, mesh, ramp: bytes, frames: int) -> Dict:
+    backend = get_backend(backend_name)
+    w, h = resolution
+    params = StreamParams(resolution, 0.5, 25, 60, 3.2, ramp=ramp, backend=backend_name)
+    projection = Matrix44.perspective_projection(params.fov, params.aspect * w / h, 0.1, 10.0)
+
+    def run():
+        renderer = backend.renderer(resolution, mesh, projection)
+        shader = ascii.Shader(resolution, ramp, header=CLEAR)
+        render_frame(renderer, shader, params, 0)  # warm up
+
+        samples = {}  # type: Dict[str, List[float]]
+        staged = 0.0
+        for frame in range(frames):
+            for stage, seconds in STAGES[backend_name](renderer, shader, params, frame / params.fps).items():
+                samples.setdefault(stage, []).append(seconds)
+                staged += seconds
+
+        start = time.perf_counter()
+        for frame in range(frames):
+            render_frame(renderer, shader, params, frame)
+        fps = frames / (time.perf_counter() - start)
+
+        tracemalloc.start()
+        render_frame(renderer, shader, params, frames)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            'stages_ms': {stage: statistics.median(s) * 1e3 for stage, s in samples.items()},
+            'fps': fps,
+            # close to fps when the stages cover the whole frame
+            'stages_fps': frames / staged,
+            'peak_bytes': peak,
+        }
+    return backend.run(run)
+
+
+def case_key(case: Dict) -> str:
+    return '{backend} {resolution} {mesh} {ramp}'.format(**case)
+
+
+def gl_renderer() -> Optional[str]:
+    """Name of the GL implementation, None if there is no GL"""
+    try:
+        return get_backend('gl').run(lambda: create_context().info['GL_RENDERER'])
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def benchmark(backends: List[str], frames: int, quick: bool) -> Dict:
+    renderer = gl_renderer() if 'gl' in backends else None
+    if 'gl' in backends and renderer is None:
+        print('no GL context, skipping the gl backend', file=sys.stderr)
+        backends = [b for b in backends if b != 'gl']
+    cases = []
+    for mesh_name, mesh in meshes(quick):
+        for resolution in RESOLUTIONS[:2] if quick else RESOLUTIONS:
+            for ramp_name, ramp in RAMPS.items():
+                for backend in backends:
+                    case = {
+                        'backend': backend,
+                        'resolution': '{}x{}'.format(*resolution),
+                        'mesh': mesh_name,
+                        'faces': len(mesh.faces),
+                        'ramp': ramp_name,
+                    }
+                    case.update(run_case(backend, resolution, mesh, ramp, frames))
+                    print('{:<40} {:>8.1f} fps {:>8.1f} fps by stages'.format(
+                        case_key(case), case['fps'], case['stages_fps']), file=sys.stderr)
+                    cases.append(case)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'gl_renderer': renderer,
+            'frames': frames,
+        },
+        'cases': cases,
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Cases and stages slower than the baseline by more than tolerance"""
+    previous = {case_key(case): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = previous.get(case_key(case))
+        if old is None:
+            continue
+        if case['fps'] < old['fps'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} fps, was {:.1f}'.format(case_key(case), case['fps'], old['fps']))
+        for stage, ms in case['stages_ms'].items():
+            before = old['stages_ms'].get(stage)
+            if before is not None and ms > before * (1 + tolerance):
+                regressions.append('{} {}: {:.3f} ms, was {:.3f}'.format(case_key(case), stage, ms, before))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default='numpy,gl')
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--quick', action='store_true', help='smaller meshes and resolutions only')
+    parser.add_argument('--output', type=Path, help='write the results here instead of stdout')
+    parser.add_argument('--baseline', type=Path, help='compare against these results')
+    parser.add_argument('--save-baseline', type=Path, help='also store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed slowdown, 0.15 is 15%%')
+    args = parser.parse_args()
+
+    results = benchmark(args.backends.split(','), args.frames, args.quick)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        args.save_baseline.write_text(text)
+
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print('regression: ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Measures the time to first frame of a fresh server worker with and without
+warm-up, run from the repository root with
+
+    python -m benchmarks.startup
+
+Starts the asgi server once per setting, waits until it accepts
+connections and then requests a stream and an image. Reports the seconds
+until the server listens and the latency of the first frame and the first
+image once it does.
+"""
+import argparse
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from urllib.request import Request, urlopen
+
+PORT = 5099
+TIMEOUT = 60.0
+
+
+def wait_listening(port: int, process: subprocess.Popen) -> None:
+    end = time.perf_counter() + TIMEOUT
+    while time.perf_counter() < end:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with {}'.format(process.returncode))
+        try:
+            socket.create_connection(('localhost', port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError('server did not listen within {}s'.format(TIMEOUT))
+
+
+def first_byte(url: str) -> float:
+    start = time.perf_counter()
+    with urlopen(Request(url, headers={'User-Agent': 'curl'}), timeout=TIMEOUT) as response:
+        response.read(1)
+    return time.perf_counter() - start
+
+
+def measure(command: str, port: int, warmup: bool):
+    env = dict(os.environ, WARMUP='1' if warmup else '0')
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        shlex.split(command) + ['--port', str(port)], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_listening(port, process)
+        listening = time.perf_counter() - start
+        frame = first_byte('http://localhost:{}/torus?resolution=80x24'.format(port))
+        image = first_byte('http://localhost:{}/torus.png?t=1'.format(port))
+        return listening, frame, image
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--command', default='{} -m uvicorn aserver:app'.format(sys.executable), help='starts the server')
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+    print('{:>8} {:>12} {:>12} {:>12}'.format('warmup', 'listening s', 'frame ms', 'image ms'))
+    for warmup in (False, True):
+        listening, frame, image = measure(args.command, args.port, warmup)
+        print('{:>8} {:>12.2f} {:>12.1f} {:>12.1f}'.format(
+            'on' if warmup else 'off', listening, frame * 1e3, image * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""Fan-out of rendered frames: one producer thread per parameter set and any
+number of subscribers reading from a shared ring buffer"""
+import asyncio
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+
+from metrics import LATENESS_SECONDS
+
+
+class SlowSubscriber(Exception):
+    """Raised to a subscriber that fell so far behind that its next frame was
+    overwritten in the ring buffer"""
+
+
+class Channel:
+    """Renders frames at a fixed rate and publishes them into a ring buffer.
+    Frame indices are counted from the epoch so channels with the same rate
+    stay in phase."""
+    def __init__(
+            self, render: Callable[[int], bytes], fps: float, epoch: float, size: int = 8):
+        self.render = render
+        self.fps = fps
+        self.epoch = epoch
+        self.ring = [b''] * size  # type: List[bytes]
+        self.seq = -1  # sequence number of the last published frame
+        self.subscribers = 0
+        self.skipped = 0
+        self.error = None  # type: Optional[BaseException]
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def publish(self, frame: bytes) -> None:
+        with self.cond:
+            self.ring[(self.seq + 1) % len(self.ring)] = frame
+            self.seq += 1
+            self.cond.notify_all()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        with self.cond:
+            self.closed = True
+            self.error = error
+            self.cond.notify_all()
+
+    def run(self, idle: Callable[[], bool]) -> None:
+        """Producer loop, returns once idle() reports that nobody listens"""
+        try:
+            while not idle():
+                frame = int((time.time() - self.epoch) * self.fps)
+                self.publish(self.render(frame))
+                delay = self.epoch + (frame + 1) / self.fps - time.time()
+                LATENESS_SECONDS.observe(max(-delay, 0))
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:  # pylint: disable=broad-except
+            self.close(e)
+        else:
+            self.close()
+
+
+class Subscription:
+    """Iterates over the frames of a channel. Lagging more than max_lag frames
+    skips ahead to the newest frame, or raises SlowSubscriber with drop=True
+    when the ring buffer has been overrun."""
+    def __init__(self, broadcaster: 'Broadcaster', key: Hashable, channel: Channel, max_lag: int, drop: bool):
+        self.broadcaster = broadcaster
+        self.key = key
+        self.channel = channel
+        self.max_lag = max_lag
+        self.drop = drop
+        self.cursor = max(channel.seq, 0)
+        self.skipped = 0
+
+    def __enter__(self) -> 'Subscription':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __iter__(self) -> 'Subscription':
+        return self
+
+    def __next__(self) -> bytes:
+        channel = self.channel
+        with channel.cond:
+            channel.cond.wait_for(lambda: channel.seq >= self.cursor or channel.closed)
+            if channel.seq < self.cursor:
+                if channel.error:
+                    raise channel.error
+                raise StopIteration
+            lag = channel.seq - self.cursor
+            if self.drop and lag >= len(channel.ring):
+                raise SlowSubscriber('{} frames behind'.format(lag))
+            if lag > self.max_lag:
+                self.skipped += lag
+                channel.skipped += lag
+                self.cursor = channel.seq
+            frame = channel.ring[self.cursor % len(channel.ring)]
+        self.cursor += 1
+        return frame
+
+    def close(self) -> None:
+        if self.channel:
+            self.broadcaster.unsubscribe(self.key, self.channel)
+            self.channel = None
+
+
+class Broadcaster:
+    """Keeps one channel per key alive while it has subscribers"""
+    def __init__(self, epoch: float, size: int = 8, linger: float = 5.0):
+        self.epoch = epoch
+        self.size = size
+        self.linger = linger
+        self.channels = {}  # type: Dict[Hashable, Channel]
+        self._idle_since = {}  # type: Dict[Channel, float]
+        self._lock = threading.Lock()
+
+    def subscribe(
+            self, key: Hashable, fps: float, create: Callable[[], Callable[[int], bytes]],
+            max_lag: int = 2, drop: bool = False) -> Subscription:
+        """Subscribes to the channel for key, create() returns the render
+        function for a new channel"""
+        with self._lock:
+            channel = self.channels.get(key)
+            if channel is None:
+                channel = Channel(create(), fps, self.epoch, self.size)
+                self.channels[key] = channel
+                threading.Thread(
+                    target=self._run, args=(key, channel),
+                    name='broadcast-{}'.format(key), daemon=True).start()
+            channel.subscribers += 1
+            self._idle_since.pop(channel, None)
+            return Subscription(self, key, channel, max_lag, drop)
+
+    def unsubscribe(self, key: Hashable, channel: Channel) -> None:
+        with self._lock:
+            channel.subscribers -= 1
+            if channel.subscribers == 0:
+                self._idle_since[channel] = time.monotonic()
+
+    def _run(self, key: Hashable, channel: Channel) -> None:
+        channel.run(lambda: self._idle(key, channel))
+        # a failed channel must not be handed out to new subscribers
+        with self._lock:
+            if self.channels.get(key) is channel:
+                del self.channels[key]
+            self._idle_since.pop(channel, None)
+
+    def _idle(self, key: Hashable, channel: Channel) -> bool:
+        with self._lock:
+            idle_since = self._idle_since.get(channel)
+            if idle_since is None or time.monotonic() - idle_since < self.linger:
+                return False
+            del self._idle_since[channel]
+            del self.channels[key]
+            return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            channels = list(self.channels.values())
+        return {
+            'channels': len(channels),
+            'subscribers': sum(c.subscribers for c in channels),
+            'published': sum(c.seq + 1 for c in channels),
+            'skipped': sum(c.skipped for c in channels),
+        }
+
+
+class AsyncChannel:
+    """Event loop counterpart of Channel. Paces with asyncio.sleep and only
+    keeps the newest frame since subscribers always skip to it."""
+    def __init__(self, render: Callable[[int], Awaitable[bytes]], fps: float, epoch: float):
+        self.render = render
+        self.fps = fps
+        self.epoch = epoch
+        self.frame = b''
+        self.seq = -1
+        self.subscribers = 0
+        self.skipped = 0
+        self.error = None  # type: Optional[BaseException]
+        self.closed = False
+        self.changed = asyncio.Event()
+
+    def publish(self, frame: bytes) -> None:
+        self.frame = frame
+        self.seq += 1
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        self.closed = True
+        self.error = error
+        self.changed.set()
+
+    async def run(self, idle: Callable[[], bool]) -> None:
+        try:
+            while not idle():
+                frame = int((time.time() - self.epoch) * self.fps)
+                self.publish(await self.render(frame))
+                delay = self.epoch + (frame + 1) / self.fps - time.time()
+                LATENESS_SECONDS.observe(max(-delay, 0))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        except Exception as e:  # pylint: disable=broad-except
+            self.close(e)
+        else:
+            self.close()
+
+
+class AsyncSubscription:
+    def __init__(self, broadcaster: 'AsyncBroadcaster', key: Hashable, channel: AsyncChannel):
+        self.broadcaster = broadcaster
+        self.key = key
+        self.channel = channel
+        self.cursor = max(channel.seq, 0)
+        self.skipped = 0
+
+    def __enter__(self) -> 'AsyncSubscription':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __aiter__(self) -> 'AsyncSubscription':
+        return self
+
+    async def __anext__(self) -> bytes:
+        channel = self.channel
+        while channel.seq < self.cursor and not channel.closed:
+            await channel.changed.wait()
+        if channel.seq < self.cursor:
+            if channel.error:
+                raise channel.error
+            raise StopAsyncIteration
+        lag = channel.seq - self.cursor
+        self.skipped += lag
+        channel.skipped += lag
+        self.cursor = channel.seq + 1
+        return channel.frame
+
+    def close(self) -> None:
+        if self.channel:
+            self.broadcaster.unsubscribe(self.channel)
+            self.channel = None
+
+
+class AsyncBroadcaster:
+    """Keeps one AsyncChannel task per key alive while it has subscribers.
+    Must only be used from the event loop thread."""
+    def __init__(self, epoch: float, linger: float = 5.0):
+        self.epoch = epoch
+        self.linger = linger
+        self.channels = {}  # type: Dict[Hashable, AsyncChannel]
+        self._idle_since = {}  # type: Dict[AsyncChannel, float]
+
+    def subscribe(
+            self, key: Hashable, fps: float,
+            create: Callable[[], Callable[[int], Awaitable[bytes]]]) -> AsyncSubscription:
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = AsyncChannel(create(), fps, self.epoch)
+            asyncio.ensure_future(self._run(key, channel))
+        channel.subscribers += 1
+        self._idle_since.pop(channel, None)
+        return AsyncSubscription(self, key, channel)
+
+    def unsubscribe(self, channel: AsyncChannel) -> None:
+        channel.subscribers -= 1
+        if channel.subscribers == 0:
+            self._idle_since[channel] = time.monotonic()
+
+    async def _run(self, key: Hashable, channel: AsyncChannel) -> None:
+        await channel.run(lambda: self._idle(channel))
+        if self.channels.get(key) is channel:
+            del self.channels[key]
+        self._idle_since.pop(channel, None)
+
+    def _idle(self, channel: AsyncChannel) -> bool:
+        idle_since = self._idle_since.get(channel)
+        return idle_since is not None and time.monotonic() - idle_since >= self.linger
+
+    def stats(self) -> Dict[str, int]:
+        channels = list(self.channels.values())
+        return {
+            'channels': len(channels),
+            'subscribers': sum(c.subscribers for c in channels),
+            'published': sum(c.seq + 1 for c in channels),
+            'skipped': sum(c.skipped for c in channels),
+        }
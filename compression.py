@@ -0,0 +1,103 @@
+"""Content-Encoding of frame streams.
+
+Every connection has one long lived compressor that is sync flushed after
+each frame, so frames arrive as soon as they are sent while the window of
+the compressor still spans the previous frames. zstd is only offered when
+the zstandard package is installed."""
+import threading
+import time
+from typing import Dict, Optional
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# In order of preference
+ENCODINGS = (('zstd',) if zstandard else ()) + ('gzip', 'deflate')
+
+LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """The preferred encoding the client accepts, None for identity"""
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        weight = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().lower()] = weight
+    for encoding in ENCODINGS:
+        if weights.get(encoding, weights.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+class CompressionStats:
+    """Thread safe counters for one encoding"""
+    def __init__(self):
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, bytes_in: int, bytes_out: int, cpu_seconds: float) -> None:
+        with self._lock:
+            self.frames += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.cpu_seconds += cpu_seconds
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            frames = max(self.frames, 1)
+            return {
+                'frames': self.frames,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.bytes_in / max(self.bytes_out, 1),
+                'cpu_seconds_per_frame': self.cpu_seconds / frames,
+            }
+
+
+compression_stats = {encoding: CompressionStats() for encoding in ENCODINGS}
+
+
+class StreamCompressor:
+    """Compresses the frames sent to one client"""
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self.stats = compression_stats[encoding]
+        if encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            # gzip has a gzip header, deflate is the zlib format despite its name
+            wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+            self._compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, wbits)
+            self._flush_mode = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data: bytes) -> bytes:
+        """Compressed data that decompresses to everything sent so far"""
+        start = time.thread_time()
+        out = self._compressor.compress(data) + self._compressor.flush(self._flush_mode)
+        self.stats.add(len(data), len(out), time.thread_time() - start)
+        return out
+
+    def finish(self) -> bytes:
+        """Ends the stream, send the result last"""
+        return self._compressor.flush()
+
+
+def stream_compressor(accept_encoding: str) -> Optional[StreamCompressor]:
+    encoding = negotiate(accept_encoding)
+    return StreamCompressor(encoding) if encoding else None
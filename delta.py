@@ -0,0 +1,123 @@
+"""Delta encoding of ascii frames for terminals.
+
+A full frame clears the screen and writes every line. A delta frame only
+rewrites the runs of characters that changed since the previous frame sent
+to the same client. Full frames are sent without their last newline so that
+a terminal exactly as high as the frame does not scroll, rows of delta
+frames are then addressed from the top left corner the full frame started
+in."""
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+CLEAR = b"\033[2J\033[1;1H"  # clear and move to top left
+
+# Re-sending this many unchanged characters is cheaper than moving the cursor
+GAP = 6
+
+
+class ByteStats:
+    """Thread safe byte counters for one encoding mode"""
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.full_bytes = 0  # what full frames would have cost
+        self._lock = threading.Lock()
+
+    def add(self, sent: int, full: int) -> None:
+        with self._lock:
+            self.frames += 1
+            self.bytes += sent
+            self.full_bytes += full
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            frames = max(self.frames, 1)
+            return {
+                'frames': self.frames,
+                'bytes': self.bytes,
+                'bytes_per_frame': self.bytes / frames,
+                'full_bytes_per_frame': self.full_bytes / frames,
+            }
+
+
+def parse(frame: bytes) -> Optional[np.array]:
+    """Returns a full frame, bytes or a memoryview, as a (h, w + 1) array of
+    characters including the trailing newlines, or None if it does not look
+    like one"""
+    data = np.frombuffer(frame, dtype=np.uint8)
+    if data[:len(CLEAR)].tobytes() != CLEAR:
+        return None
+    body = data[len(CLEAR):]
+    if not len(body):
+        return None
+    newline = body == ord('\n')
+    stride = int(newline.argmax()) + 1
+    if not newline[stride - 1] or len(body) % stride:
+        return None
+    grid = body.reshape(-1, stride)
+    if not (grid[:, -1] == ord('\n')).all():
+        return None
+    return grid
+
+
+def runs(columns: np.array, gap: int = GAP) -> List[tuple]:
+    """Groups sorted column indices into [start, end) runs, joining runs that
+    are separated by at most gap columns"""
+    breaks = np.flatnonzero(np.diff(columns) > gap + 1)
+    starts = columns[np.r_[0, breaks + 1]]
+    ends = columns[np.r_[breaks, len(columns) - 1]] + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def diff(previous: np.array, grid: np.array) -> bytes:
+    """Escape sequences turning previous into grid on a screen where the
+    full frame started top left, leaving the cursor at the end of the last
+    line like the full frame did"""
+    h, stride = grid.shape
+    changed = previous[:, :-1] != grid[:, :-1]
+    out = []
+    row = None
+    for r in np.flatnonzero(changed.any(axis=1)).tolist():
+        for start, end in runs(np.flatnonzero(changed[r])):
+            if r == row:
+                out.append(b'\033[%dG' % (start + 1))
+            else:
+                out.append(b'\033[%d;%dH' % (r + 1, start + 1))
+            row = r
+            out.append(grid[r, start:end].tobytes())
+    if out:
+        out.append(b'\033[%d;%dH' % (h, stride))
+    return b''.join(out)
+
+
+class DeltaEncoder:
+    """Encodes the frames sent to one client. Every keyframe_interval frames,
+    and whenever the delta would not be smaller, a full frame is sent.
+    keyframe_interval=1 disables delta encoding and sends the frames as
+    they are."""
+    def __init__(self, keyframe_interval: int = 50, stats: Optional[ByteStats] = None):
+        self.keyframe_interval = keyframe_interval
+        self.stats = stats
+        self.previous = None  # type: Optional[np.array]
+        self.count = 0
+
+    def encode(self, frame: bytes) -> bytes:
+        grid = parse(frame) if self.keyframe_interval > 1 else None
+        out = None
+        if (grid is not None and self.previous is not None and self.previous.shape == grid.shape
+                and self.count % self.keyframe_interval):
+            delta = diff(self.previous, grid)
+            if len(delta) < len(frame) - 1:
+                out = delta
+        if out is None:
+            # the last newline would scroll the top line out of a terminal
+            # as high as the frame
+            out = frame if grid is None else frame[:-1]
+            self.count = 0
+        self.count += 1
+        self.previous = grid
+        if self.stats:
+            self.stats.add(len(out), len(frame))
+        return out
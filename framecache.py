@@ -0,0 +1,79 @@
+"""Process wide cache of encoded frames"""
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+from typing import Callable, Dict, Hashable, Tuple
+
+
+class FrameCache:
+    """LRU cache with a time to live and a bound on the total number of bytes.
+    Concurrent misses on the same key are coalesced so only one caller
+    renders while the others wait for its result."""
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, ttl: float = 2.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # type: OrderedDict[Hashable, Tuple[float, bytes]]
+        self._pending = {}  # type: Dict[Hashable, Future]
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float) -> None:
+        expired = [key for key, (created, _) in self._entries.items() if now - created >= self.ttl]
+        for key in expired:
+            self.nbytes -= len(self._entries.pop(key)[1])
+        # entries are ordered by last use
+        while self.nbytes > self.max_bytes:
+            _, (_, frame) = self._entries.popitem(last=False)
+            self.nbytes -= len(frame)
+
+    def get_or_render(self, key: Hashable, render: Callable[[], bytes]) -> bytes:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            pending = self._pending.get(key)
+            if pending:
+                self.hits += 1
+            else:
+                self.misses += 1
+                future = self._pending[key] = Future()
+        if pending:
+            return pending.result()
+
+        try:
+            frame = render()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._pending[key]
+            now = time.monotonic()
+            old = self._entries.pop(key, None)
+            if old:
+                self.nbytes -= len(old[1])
+            self._entries[key] = (now, frame)
+            self.nbytes += len(frame)
+            self._evict(now)
+        future.set_result(frame)
+        return frame
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
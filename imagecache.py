@@ -0,0 +1,186 @@
+"""Cache of rendered /torus.png images.
+
+An image is a pure function of its normalized parameters, so it is
+addressed by a hash of them, which also serves as its strong ETag. A client
+or CDN that already has an image is answered from the hash alone. Images
+are kept in memory, least recently used evicted first. When IMAGE_CACHE is
+set to a directory, they are also written there, where other workers and
+later restarts find them. The directory is bounded by IMAGE_CACHE_DISK_BYTES,
+the least recently used images by mtime are removed first, down to
+PRUNE_TO of it so that it is not scanned again on the next write. Failing to
+write it is logged, the image is served anyway."""
+import hashlib
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from framecache import FrameCache
+
+logger = logging.getLogger(__name__)
+
+# Bump when the same parameters render to different bytes
+IMAGE_VERSION = 1
+
+MAX_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', 64 * 1024 * 1024))
+MAX_DISK_BYTES = int(os.environ.get('IMAGE_CACHE_DISK_BYTES', 256 * 1024 * 1024))
+MAX_AGE = int(os.environ.get('IMAGE_MAX_AGE', 24 * 60 * 60))
+# Share of max_disk_bytes left after pruning
+PRUNE_TO = 0.9
+# Images are written to temporary files named .<etag>... first, older ones
+# were left behind by workers that died while writing them
+TEMP_PREFIX = '.'
+MAX_TEMP_AGE = 60 * 60
+
+
+def image_etag(params: Sequence) -> str:
+    """Hash of the json of the parameters, floats are written the same for
+    equal values so equal parameters hash the same"""
+    canonical = json.dumps([IMAGE_VERSION] + list(params), separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:32]
+
+
+def not_modified(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header matches the etag, compared weakly
+    as RFC 7232 asks for"""
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag in ('*', '"{}"'.format(etag)):
+            return True
+    return False
+
+
+def cache_headers(etag: str) -> List[Tuple[str, str]]:
+    return [('ETag', '"{}"'.format(etag)), ('Cache-Control', 'public, max-age={}'.format(MAX_AGE))]
+
+
+class ImageCache:
+    """Images by etag in memory, and on disk when there is a directory.
+    Concurrent misses of the same image are rendered once."""
+    def __init__(
+            self, max_bytes: int = MAX_BYTES, directory: Optional[Path] = None, max_disk_bytes: int = MAX_DISK_BYTES):
+        self.memory = FrameCache(max_bytes, ttl=math.inf)
+        self.directory = None if directory is None else Path(directory)
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_hits = 0
+        self.disk_writes = 0
+        self.disk_evictions = 0
+        self.disk_errors = 0
+        self.not_modified = 0
+        # bytes in the directory as of the last prune plus what this worker
+        # wrote since, None until the first prune
+        self._disk_bytes = None  # type: Optional[int]
+        self._lock = threading.Lock()
+
+    def get_or_render(self, etag: str, render: Callable[[], bytes]) -> bytes:
+        return self.memory.get_or_render(etag, lambda: self._load_or_render(etag, render))
+
+    def _load_or_render(self, etag: str, render: Callable[[], bytes]) -> bytes:
+        if self.directory is None:
+            return render()
+        path = self.directory / etag
+        try:
+            data = path.read_bytes()
+        except OSError:
+            data = None
+        if data is not None:
+            with self._lock:
+                self.disk_hits += 1
+            try:
+                # the mtime orders images by last use for pruning
+                os.utime(str(path))
+            except OSError:
+                pass
+            return data
+
+        data = render()
+        try:
+            self._write(path, data)
+            if self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes:
+                self._prune()
+        except OSError as e:
+            logger.warning('could not write %s to the image cache: %s', path, e)
+            with self._lock:
+                self.disk_errors += 1
+        return data
+
+    def _write(self, path: Path, data: bytes) -> None:
+        """Writes atomically, other workers may read it any time"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=TEMP_PREFIX + path.name, dir=str(self.directory))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp creates the file readable by its owner only, workers
+            # running as other users read it too
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, str(path))
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self.disk_writes += 1
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data)
+
+    def _prune(self) -> None:
+        """Scans the directory and removes the least recently used images
+        once it holds more than max_disk_bytes, down to PRUNE_TO of it"""
+        files = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(str(self.directory)):
+            try:
+                stat = entry.stat()
+            except OSError:
+                # removed by another worker
+                continue
+            if entry.name.startswith(TEMP_PREFIX):
+                # other workers may be writing it
+                if now - stat.st_mtime > MAX_TEMP_AGE:
+                    self._unlink(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        evicted = 0
+        if total > self.max_disk_bytes:
+            for _, size, path in sorted(files):
+                if total <= self.max_disk_bytes * PRUNE_TO:
+                    break
+                evicted += self._unlink(path)
+                total -= size
+        with self._lock:
+            self.disk_evictions += evicted
+            self._disk_bytes = total
+
+    @staticmethod
+    def _unlink(path: str) -> int:
+        """Removes a file, returns 0 if another worker already did"""
+        try:
+            os.unlink(path)
+            return 1
+        except OSError:
+            return 0
+
+    def count_not_modified(self) -> None:
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(
+                self.memory.stats(), disk_hits=self.disk_hits, disk_writes=self.disk_writes,
+                disk_evictions=self.disk_evictions, disk_errors=self.disk_errors, not_modified=self.not_modified)
+
+
+image_cache = ImageCache(directory=os.environ.get('IMAGE_CACHE') or None)
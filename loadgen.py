@@ -0,0 +1,85 @@
+"""Opens many concurrent /torus streams and reports how many of them are
+actually receiving frames.
+
+    python loadgen.py http://localhost:5000/torus --connections 2000
+
+Raise the open file limit (ulimit -n) on both ends for large counts."""
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.received = 0
+        self.last_seen = {}  # connection id -> time of last chunk
+
+    def live(self, now: float, window: float = 1.0) -> int:
+        return sum(1 for t in self.last_seen.values() if now - t < window)
+
+
+async def stream(i: int, host: str, port: int, target: str, stats: Stats) -> None:
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        stats.failed += 1
+        return
+    stats.connected += 1
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: curl/loadgen\r\n\r\n'.format(target, host).encode())
+    try:
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            stats.received += len(chunk)
+            stats.last_seen[i] = time.monotonic()
+    except OSError:
+        stats.failed += 1
+    finally:
+        stats.connected -= 1
+        stats.last_seen.pop(i, None)
+        writer.close()
+
+
+async def run(url: str, connections: int, rate: float, duration: float) -> None:
+    parts = urlsplit(url)
+    target = parts.path + ('?' + parts.query if parts.query else '')
+    stats = Stats()
+    tasks = []
+    start = time.monotonic()
+    received = 0
+    best = 0
+    while time.monotonic() - start < duration:
+        elapsed = time.monotonic() - start
+        while len(tasks) < min(connections, int(elapsed * rate) + 1):
+            tasks.append(asyncio.ensure_future(
+                stream(len(tasks), parts.hostname, parts.port or 80, target, stats)))
+        await asyncio.sleep(1)
+        live = stats.live(time.monotonic())
+        best = max(best, live)
+        print('{:6.1f}s opened {:6d} connected {:6d} live {:6d} failed {:6d} {:8.1f} KiB/s'.format(
+            time.monotonic() - start, len(tasks), stats.connected, live, stats.failed,
+            (stats.received - received) / 1024))
+        received = stats.received
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    print('max live streams: {}'.format(best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=100, help='new connections per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args.url, args.connections, args.rate, args.duration))
+
+
+if __name__ == '__main__':
+    main()
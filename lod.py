@@ -0,0 +1,251 @@
+"""Levels of detail of meshes.
+
+simplify() collapses edges by the quadric error metric of Garland and
+Heckbert, in passes that each collapse a set of edges that share no vertex.
+LodChain holds a mesh and successively halved simplifications of it, built
+on a background thread when the chain is created, and picks the coarsest one
+that still has about one face per pixel that the mesh covers on screen.
+Until a level is built the finer ones are drawn, rendering never waits for
+simplification."""
+import logging
+import threading
+from typing import List, Optional, Tuple
+import weakref
+
+import numpy as np
+
+from mesh import Mesh, normalized
+
+logger = logging.getLogger(__name__)
+
+Size = Tuple[int, int]
+
+# Simplification stops at this many faces
+MIN_FACES = 32
+FACES_PER_PIXEL = 1.0
+# Weight of the planes that keep open borders, e.g. seams, in place
+BOUNDARY_WEIGHT = 1000.0
+
+
+def edges(faces: np.array, vertex_count: int) -> Tuple[np.array, np.array, np.array]:
+    """The distinct (a, b) edges with a < b, a face of each and how many
+    faces share it"""
+    corners = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    ordered = np.sort(corners, axis=1)
+    _, first, counts = np.unique(
+        ordered[:, 0] * vertex_count + ordered[:, 1], return_index=True, return_counts=True)
+    return ordered[first], first % len(faces), counts
+
+
+def plane_quadrics(planes: np.array, weights: np.array) -> np.array:
+    """weight * p p^T of each plane (a, b, c, d)"""
+    return weights[:, None, None] * planes[:, :, None] * planes[:, None, :]
+
+
+def accumulate(quadrics: np.array, vertices: np.array, vertex_count: int) -> np.array:
+    """Sums the (n, 4, 4) quadrics into the vertices, (n, k) indices"""
+    k = vertices.shape[1]
+    weights = np.repeat(quadrics.reshape(-1, 16), k, axis=0)
+    indices = vertices.ravel()
+    out = np.empty((vertex_count, 16))
+    for column in range(16):
+        out[:, column] = np.bincount(indices, weights=weights[:, column], minlength=vertex_count)
+    return out.reshape(-1, 4, 4)
+
+
+def vertex_quadrics(vertices: np.array, faces: np.array) -> np.array:
+    """The area weighted quadrics of the planes of the faces around each
+    vertex, plus perpendicular planes along open borders"""
+    p0, p1, p2 = np.moveaxis(vertices[faces], 1, 0)
+    cross = np.cross(p1 - p0, p2 - p0)
+    normals = normalized(cross)
+    planes = np.hstack([normals, -np.sum(normals * p0, axis=1, keepdims=True)])
+    quadrics = accumulate(plane_quadrics(planes, np.linalg.norm(cross, axis=1) / 2), faces, len(vertices))
+
+    pairs, face, counts = edges(faces, len(vertices))
+    border, face = pairs[counts == 1], face[counts == 1]
+    if len(border):
+        a, b = vertices[border[:, 0]], vertices[border[:, 1]]
+        perpendicular = normalized(np.cross(b - a, normals[face]))
+        planes = np.hstack([perpendicular, -np.sum(perpendicular * a, axis=1, keepdims=True)])
+        weights = BOUNDARY_WEIGHT * np.sum((b - a) ** 2, axis=1)
+        quadrics += accumulate(plane_quadrics(planes, weights), border, len(vertices))
+    return quadrics
+
+
+def error(quadrics: np.array, points: np.array) -> np.array:
+    v = np.hstack([points, np.ones((len(points), 1))])
+    return np.einsum('ei,eij,ej->e', v, quadrics, v)
+
+
+def flipped(vertices: np.array, positions: np.array, faces: np.array, collapsed: np.array) -> np.array:
+    """Faces that turn over when moved from vertices to positions through the
+    remapped faces collapsed"""
+    p0, p1, p2 = np.moveaxis(vertices[faces], 1, 0)
+    q0, q1, q2 = np.moveaxis(positions[collapsed], 1, 0)
+    return np.sum(np.cross(p1 - p0, p2 - p0) * np.cross(q1 - q0, q2 - q0), axis=1) < 0
+
+
+def collapse_pass(vertices: np.array, faces: np.array, quadrics: np.array, target: int):
+    """Collapses the cheapest edges that share no vertex, at most as many as
+    needed to get down to target faces. Returns the new vertices, faces,
+    quadrics and the vertex every old vertex was merged into, or None when
+    no edge can be collapsed."""
+    pairs, _, _ = edges(faces, len(vertices))
+    a, b = pairs[:, 0], pairs[:, 1]
+    q = quadrics[a] + quadrics[b]
+    candidates = [vertices[a], vertices[b], (vertices[a] + vertices[b]) / 2]
+    costs = np.array([error(q, c) for c in candidates])
+    best = np.argmin(costs, axis=0)
+    placement = np.choose(best[:, None], candidates)
+    cost = costs[best, np.arange(len(best))]
+
+    # every vertex picks its cheapest edge, edges picked by both ends share
+    # no vertex with other picked edges. Ranks break ties between equal costs.
+    rank = np.empty(len(cost), dtype=np.int64)
+    rank[np.argsort(cost, kind='stable')] = np.arange(len(cost))
+    cheapest = np.full(len(vertices), len(cost))
+    np.minimum.at(cheapest, a, rank)
+    np.minimum.at(cheapest, b, rank)
+    selected = np.flatnonzero((cheapest[a] == rank) & (cheapest[b] == rank))
+    # each collapse removes about two faces
+    selected = selected[np.argsort(rank[selected])][:max((len(faces) - target + 1) // 2, 1)]
+
+    while len(selected):
+        remap = np.arange(len(vertices))
+        remap[b[selected]] = a[selected]
+        positions = vertices.copy()
+        positions[a[selected]] = placement[selected]
+        collapsed = remap[faces]
+        degenerate = ((collapsed[:, 0] == collapsed[:, 1]) | (collapsed[:, 1] == collapsed[:, 2])
+                      | (collapsed[:, 2] == collapsed[:, 0]))
+        flips = flipped(vertices, positions, faces, collapsed) & ~degenerate
+        if not flips.any():
+            break
+        rejected = np.zeros(len(vertices), dtype=bool)
+        rejected[faces[flips].ravel()] = True
+        selected = selected[~(rejected[a[selected]] | rejected[b[selected]])]
+    else:
+        return None
+
+    quadrics = quadrics.copy()
+    quadrics[a[selected]] = q[selected]
+    collapsed = collapsed[~degenerate]
+    # collapses may leave two faces on the same corners
+    _, unique = np.unique(np.sort(collapsed, axis=1), axis=0, return_index=True)
+    return positions, collapsed[np.sort(unique)], quadrics, remap
+
+
+def simplify(mesh: Mesh, target: int) -> Mesh:
+    """Collapses edges until the mesh has at most about target faces or no
+    edge can be collapsed without turning a face over"""
+    vertices = np.asarray(mesh.vertices, dtype=np.float64)
+    faces = np.asarray(mesh.faces, dtype=np.int64)
+    normals = None if mesh.vertex_normals is None else np.array(mesh.vertex_normals, dtype=np.float64)
+    texcoords = None if mesh.texcoords is None else np.asarray(mesh.texcoords)
+    quadrics = vertex_quadrics(vertices, faces)
+    while len(faces) > target:
+        collapsed = collapse_pass(vertices, faces, quadrics, target)
+        if collapsed is None:
+            break
+        vertices, faces, quadrics, remap = collapsed
+        if normals is not None:
+            merged = np.flatnonzero(remap != np.arange(len(remap)))
+            np.add.at(normals, remap[merged], normals[merged])
+
+    # drop the vertices that were merged away
+    used, faces = np.unique(faces, return_inverse=True)
+    simplified = Mesh(
+        vertices[used], faces.reshape(-1, 3),
+        vertex_normals=None if normals is None else normalized(normals[used]),
+        texcoords=None if texcoords is None else texcoords[used])
+    if simplified.vertex_normals is None:
+        simplified.compute_vertex_normals()
+    return simplified
+
+
+class LodChain:
+    """A mesh and simplifications of it with about half the faces of the
+    previous level, down to MIN_FACES or until the mesh can not be simplified
+    further. start() simplifies the levels on a background thread."""
+    def __init__(self, mesh: Mesh, min_faces: int = MIN_FACES):
+        self.levels = [mesh]  # type: List[Mesh]
+        self.min_faces = min_faces
+        self.complete = len(mesh.faces) // 2 < min_faces
+        vertices = np.asarray(mesh.vertices)
+        self.center = (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+        self.radius = np.linalg.norm(vertices - self.center, axis=1).max()
+        self._lock = threading.Lock()
+
+    def level(self, i: int) -> Optional[Mesh]:
+        """The i:th level, None past the coarsest"""
+        with self._lock:
+            while len(self.levels) <= i and not self.complete:
+                previous = self.levels[-1]
+                simplified = simplify(previous, len(previous.faces) // 2)
+                # stop once collapses mostly turn faces over
+                if 4 * len(simplified.faces) > 3 * len(previous.faces):
+                    self.complete = True
+                    break
+                self.levels.append(simplified)
+                self.complete = len(simplified.faces) // 2 < self.min_faces
+            return self.levels[i] if i < len(self.levels) else None
+
+    def build(self) -> List[Mesh]:
+        """Simplifies all levels now, or waits for them"""
+        while self.level(len(self.levels)) is not None:
+            pass
+        return self.levels
+
+    def start(self) -> None:
+        """Simplifies all levels on a daemon thread"""
+        if not self.complete:
+            threading.Thread(target=self._build, name='lod', daemon=True).start()
+
+    def _build(self) -> None:
+        try:
+            self.build()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('could not simplify a mesh of %d faces', len(self.levels[0].faces))
+            # the levels built so far are still drawn
+            self.complete = True
+
+    def coverage(self, projection: np.array, camera: np.array, size: Size) -> float:
+        """Pixels covered by the bounding sphere, projection and camera laid
+        out the way GL reads them like the uniforms of the renderers"""
+        w, h = size
+        projection = np.asarray(projection)
+        view = np.append(self.center, 1) @ np.asarray(camera)
+        distance = -view[2]
+        if distance <= self.radius:
+            return float(w * h)
+        rx = self.radius * abs(projection[0, 0]) / distance * w / 2
+        ry = self.radius * abs(projection[1, 1]) / distance * h / 2
+        return min(np.pi * rx * ry, float(w * h))
+
+    def for_coverage(self, pixels: float) -> Mesh:
+        """The coarsest level built so far with at least FACES_PER_PIXEL
+        faces per pixel"""
+        # levels are only ever appended, by the thread that builds them
+        levels = self.levels
+        i = 0
+        while i + 1 < len(levels) and len(levels[i + 1].faces) >= pixels * FACES_PER_PIXEL:
+            i += 1
+        return levels[i]
+
+    def select(self, projection: np.array, camera: np.array, size: Size) -> Mesh:
+        return self.for_coverage(self.coverage(projection, camera, size))
+
+
+_chains = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary[Mesh, LodChain]
+_chains_lock = threading.Lock()
+
+
+def lod_chain(mesh: Mesh) -> LodChain:
+    """The chain of a mesh, shared by everything that renders it"""
+    with _chains_lock:
+        chain = _chains.get(mesh)
+        if chain is None:
+            chain = _chains[mesh] = LodChain(mesh)
+            chain.start()
+        return chain
@@ -1,26 +1,28 @@
+import os
 from pathlib import Path
 import sys
 
 import numpy as np
 
 import ascii
+from delta import CLEAR, ByteStats, DeltaEncoder
 from mesh import Mesh
 from mesh_io import load_obj
-from pygl import Program, vec4
+from parallel import ParallelProgram
+from pygl import Program, VertexStage
 import numgl
 from torus import torus
 
 
+stage = VertexStage()
+
+
 # Only called _once_ per render, should compute all vertices
 def vertex_shader(positions_in, normals_in, uniforms):
-    projection = uniforms['projection']
     model_view = uniforms['model_view']
-    ambient = uniforms['ambient']
-    mvp = projection @ model_view
-    light = uniforms['light1']
-    positions = mvp @ vec4(positions_in, 1).T
-    normals = np.linalg.inv(model_view).T @ vec4(normals_in, 0).T
-    return positions.T, {'intensity': np.clip(np.sum(normals.T * light, axis=1), 0, 1) + ambient}
+    positions = stage.positions(uniforms['projection'] @ model_view, positions_in)
+    intensity = stage.lambert(model_view, normals_in, uniforms['light1'][:3], uniforms['ambient'])
+    return positions, {'intensity': intensity}
 
 
 def fragment_shader(inputs):
@@ -29,23 +31,40 @@ def fragment_shader(inputs):
     return intensity.T
 
 
-def draw(resolution, mesh, aspect=1):
+def draw(resolution, mesh, aspect=1, workers=1):
     w, h = resolution
-    buffer = np.zeros((h, w), dtype=np.float)
-    
+    if workers > 1:
+        # bands of the frame are rasterized by worker processes
+        program = ParallelProgram(
+            vertex_shader=vertex_shader, fragment_shader=fragment_shader, workers=workers, dtype=np.float32)
+        buffer = program.buffer((h, w), np.float32)
+        z_buffer = program.buffer((h, w), np.float32)
+    else:
+        program = Program(vertex_shader=vertex_shader, fragment_shader=fragment_shader, dtype=np.float32)
+        buffer = np.zeros((h, w), dtype=np.float32)
+        z_buffer = np.empty(buffer.shape[:2], dtype=np.float32)
+
     light1 = numgl.normalized(np.array([0, -1, -1, 0]))
 
-    z_buffer = np.empty(buffer.shape[:2])
-    program = Program(vertex_shader=vertex_shader, fragment_shader=fragment_shader)
     projection = numgl.perspective(90, aspect * w / h, 0.1, 5)
     wx, wy = 0.03, 0.01
+    stats = ByteStats()
+    encoder = DeltaEncoder(stats=stats)
+    shader = ascii.Shader(resolution, header=CLEAR)
     for a in range(1024):
         camera = numgl.translate((0, 0, -10)) @ numgl.roty(a * wy) @ numgl.rotx(a * wx)
         buffer.fill(0)
         program.render(buffer, z_buffer, mesh, projection=projection, model_view=camera, light1=light1, ambient=0.3)
-        final = ascii.shade(buffer)
-        print("\033[2J\033[1;1H")  # clear and move to top left
-        sys.stdout.buffer.write(final)
+        shader.shade(buffer)
+        sys.stdout.buffer.write(encoder.encode(shader.frame.tobytes()))
+        sys.stdout.buffer.flush()
+    if workers > 1:
+        program.close()
+    # the encoder leaves the cursor at the end of the last line
+    sys.stdout.buffer.write(b'\n')
+    summary = stats.stats()
+    print("bytes per frame: {:.0f} delta, {:.0f} full".format(
+        summary['bytes_per_frame'], summary['full_bytes_per_frame']), file=sys.stderr)
 
 def raw(buffer: np.array) -> bytes:
     return buffer.tobytes()
@@ -53,6 +72,7 @@ def raw(buffer: np.array) -> bytes:
 def main():
     mesh = torus(1, 0.4, 8, 8)
     draw((80, 24), mesh, aspect=0.5)
-    #draw((320, 200), mesh, raw)
+    #draw((320, 200), mesh, workers=os.cpu_count())
 
-main()
+if __name__ == '__main__':
+    main()
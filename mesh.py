@@ -2,28 +2,30 @@ import numpy as np
 
 
 def normalized(a, axis=-1, order=2):
-    n = np.atleast_1d(np.linalg.norm(a, order, axis))
-    return a / n
+    n = np.linalg.norm(a, order, axis, keepdims=True)
+    # leave zero vectors, e.g. normals of degenerate faces, as they are
+    return a / np.where(n == 0, 1, n)
 
 
 class Mesh:
-    def __init__(self, vertices, faces, vertex_normals=None):
+    def __init__(self, vertices, faces, vertex_normals=None, texcoords=None):
         self.vertices = vertices
         self.faces = faces
         self.face_normals = None
         self.vertex_normals = vertex_normals
-
-    def _face_normal(self, face) -> np.array:
-        p0, p1, p2 = [self.vertices[i] for i in face]
-        return normalized(np.cross(p2 - p0, p1 - p0))
+        self.texcoords = texcoords
 
     def compute_face_normals(self) -> None:
-        self.face_normals = [self._face_normal(f) for f in self.faces]
+        p0, p1, p2 = np.moveaxis(self.vertices[np.asarray(self.faces)], 1, 0)
+        self.face_normals = normalized(np.cross(p2 - p0, p1 - p0))
 
     def compute_vertex_normals(self) -> None:
+        """Sums the normals of the faces around each vertex"""
         self.compute_face_normals()
-        normals = np.zeros(self.vertices.shape)
-        for face, face_normal in zip(self.faces, self.face_normals):
-            normals[face] += face_normal
+        indices = np.asarray(self.faces).ravel()
+        normals = np.empty(self.vertices.shape)
+        for axis in range(normals.shape[1]):
+            weights = np.repeat(self.face_normals[:, axis], 3)
+            normals[:, axis] = np.bincount(indices, weights=weights, minlength=len(normals))
 
-        self.vertex_normals = normalized(normals, axis=0)
\ No newline at end of file
+        self.vertex_normals = normalized(normals)
@@ -1,28 +1,278 @@
+import os
 from pathlib import Path
+import shutil
+import tempfile
+from typing import Dict, Optional, Tuple
 
 import numpy as np
 
 from mesh import Mesh
 
+# Bytes of the file parsed at a time
+CHUNK_BYTES = 1 << 24
 
-def is_comment(line: str) -> bool:
-    return line.startswith('#')
+# Bump when the layout of the binary cache changes
+CACHE_VERSION = 1
 
 
-def load_obj(path: Path) -> Mesh:
-    vertices = []
-    faces = []
-    with open(path) as f:
-        for line in f:
-            if is_comment(line):
-                continue
-            parts = line.split()
-            if not parts:
+class Buffer:
+    """Preallocated rows that double in capacity when full"""
+    def __init__(self, columns: int, dtype, capacity: int = 1024):
+        self.data = np.empty((capacity, columns), dtype=dtype)
+        self.size = 0
+
+    def extend(self, rows: np.array) -> None:
+        end = self.size + len(rows)
+        if end > len(self.data):
+            grown = np.empty((max(end, 2 * len(self.data)), self.data.shape[1]), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:end] = rows
+        self.size = end
+
+    @property
+    def array(self) -> np.array:
+        return self.data[:self.size]
+
+
+# Statements read by the loader, everything else is skipped
+V, VT, VN, F = 1, 2, 3, 4
+KEYWORDS = {V: b'v ', VT: b'vt ', VN: b'vn ', F: b'f '}
+
+
+def read_chunks(f, size: int = CHUNK_BYTES):
+    """Yields blocks of whole lines"""
+    rest = b''
+    for data in iter(lambda: f.read(size), b''):
+        data = rest + data
+        cut = data.rfind(b'\n') + 1
+        rest = data[cut:]
+        if cut:
+            yield data[:cut]
+    if rest:
+        yield rest + b'\n'
+
+
+def strip_indent(chunk: bytes) -> bytes:
+    """Removes whitespace before the statement of every line"""
+    if chunk[:1] not in (b' ', b'\t') and b'\n ' not in chunk and b'\n\t' not in chunk:
+        return chunk
+    return b'\n'.join(line.lstrip(b' \t') for line in chunk.split(b'\n'))
+
+
+def classify(chunk: bytes) -> Tuple[np.array, np.array, np.array]:
+    """Start, end and statement kind of every line, the lines must not be
+    indented, see strip_indent()"""
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    ends = np.flatnonzero(data == ord('\n')) + 1
+    starts = np.append(0, ends[:-1])
+    first = data[starts]
+    second = data[np.minimum(starts + 1, len(data) - 1)]
+    kinds = np.select(
+        [(first == ord('v')) & ((second == ord(' ')) | (second == ord('\t'))),
+         (first == ord('v')) & (second == ord('t')),
+         (first == ord('v')) & (second == ord('n')),
+         (first == ord('f')) & ((second == ord(' ')) | (second == ord('\t')))],
+        [V, VT, VN, F], 0)
+    return starts, ends, kinds
+
+
+def gather(chunk: bytes, starts: np.array, ends: np.array, kinds: np.array, kind: int) -> bytes:
+    """Concatenates the lines of one kind, slicing whole runs of lines at once"""
+    lines = np.flatnonzero(kinds == kind)
+    breaks = np.flatnonzero(np.diff(lines) > 1)
+    first = lines[np.append(0, breaks + 1)]
+    last = lines[np.append(breaks, len(lines) - 1)]
+    return b''.join(chunk[a:b] for a, b in zip(starts[first].tolist(), ends[last].tolist()))
+
+
+def strip_keyword(data: bytes, kind: int) -> bytes:
+    keyword = KEYWORDS[kind]
+    return data[len(keyword):].replace(b'\n' + keyword, b'\n')
+
+
+def parse_floats(data: bytes, kind: int, lines: int, columns: int) -> np.array:
+    """Parses the first columns numbers of each line, missing ones are zero"""
+    values = np.fromstring(strip_keyword(data, kind), sep=' ')
+    if len(values) == lines * columns:
+        return values.reshape(lines, columns)
+
+    # some lines have optional or extra numbers, e.g. w or vertex colors
+    tokens = np.array(data.split())
+    starts = np.flatnonzero(tokens == KEYWORDS[kind].strip())
+    counts = np.diff(np.append(starts, len(tokens))) - 1
+    index = starts[:, None] + 1 + np.arange(columns)
+    present = np.arange(columns) < counts[:, None]
+    values = np.zeros(index.shape)
+    values[present] = tokens[index[present]].astype(np.float64)
+    return values
+
+
+def parse_face_lines(data: bytes) -> Tuple[np.array, np.array]:
+    """parse_faces() one corner at a time, for faces that mix index formats"""
+    corners = []
+    counts = []
+    for line in data.splitlines():
+        parts = line.split()[1:]
+        counts.append(len(parts))
+        for part in parts:
+            indices = (part.split(b'/') + [b'', b''])[:3]
+            corners.append([int(i) if i else 0 for i in indices])
+    return np.array(corners, dtype=np.int64).reshape(-1, 3), np.array(counts, dtype=np.int64)
+
+
+def parse_faces(data: bytes, lines: int) -> Tuple[np.array, np.array]:
+    """Parses face lines into corners of one based (vertex, texcoord, normal)
+    indices, 0 where missing, and the number of corners of each face"""
+    # v, v/vt, v//vn or v/vt/vn, the same for all corners unless they mix
+    k = data.split(None, 2)[1].count(b'/') + 1
+    numbers = data.replace(b'//', b'/0/').replace(b'/', b' ')
+    raw = np.fromstring(strip_keyword(numbers, F), dtype=np.int64, sep=' ')
+    if len(raw) == 3 * k * lines and data.count(b'/') == 3 * (k - 1) * lines:
+        counts = np.full(lines, 3)
+    else:
+        # polygons, count the corners of every line
+        tokens = np.array(data.split())
+        starts = np.flatnonzero(tokens == b'f')
+        counts = np.diff(np.append(starts, len(tokens))) - 1
+        if data.count(b'/') != (k - 1) * counts.sum() or len(raw) != k * counts.sum():
+            return parse_face_lines(data)
+    raw = raw.reshape(-1, k)
+    return np.hstack([raw, np.zeros((len(raw), 3 - k), dtype=np.int64)]), counts
+
+
+def triangulate(counts: np.array) -> np.array:
+    """Corner indices of a triangle fan over each polygon"""
+    offsets = np.cumsum(counts) - counts
+    ntriangles = np.maximum(counts - 2, 0)
+    polygon = np.repeat(np.arange(len(counts)), ntriangles)
+    local = np.arange(ntriangles.sum()) - np.repeat(np.cumsum(ntriangles) - ntriangles, ntriangles)
+    first = offsets[polygon]
+    return np.stack([first, first + local + 1, first + local + 2], axis=1)
+
+
+def parse_obj(path: Path) -> Dict[str, np.array]:
+    """Parses v, vt, vn and f statements a chunk of lines at a time into
+    growing preallocated arrays"""
+    positions = Buffer(3, np.float64)
+    texcoords = Buffer(2, np.float64)
+    normals = Buffer(3, np.float64)
+    corners = Buffer(3, np.int64)
+    counts = Buffer(1, np.int64)
+    attributes = {V: (positions, 3), VT: (texcoords, 2), VN: (normals, 3)}
+    with open(str(path), 'rb') as f:
+        for chunk in read_chunks(f):
+            chunk = strip_indent(chunk)
+            starts, ends, kinds = classify(chunk)
+            bases = np.array([positions.size, texcoords.size, normals.size])
+            for kind, (buffer, columns) in attributes.items():
+                lines = np.count_nonzero(kinds == kind)
+                if lines:
+                    data = gather(chunk, starts, ends, kinds, kind)
+                    buffer.extend(parse_floats(data, kind, lines, columns))
+
+            lines = np.count_nonzero(kinds == F)
+            if not lines:
                 continue
-            if parts[0] == 'v':
-                vertices.append([float(x.split('/')[0]) for x in parts[1:]])
-            if parts[0] == 'f':
-                faces.append([int(x.split('/')[0]) - 1 for x in parts[1:]])
+            raw, face_counts = parse_faces(gather(chunk, starts, ends, kinds, F), lines)
+            if (raw < 0).any():
+                # negative indices count back from the last statement before the face
+                seen = np.cumsum([kinds == kind for kind in (V, VT, VN)], axis=1).T[kinds == F]
+                raw = np.where(raw < 0, raw + np.repeat(bases + seen, face_counts, axis=0) + 1, raw)
+            corners.extend(raw - 1)
+            counts.extend(face_counts[:, None])
+
+    return {
+        'positions': positions.array,
+        'texcoords': texcoords.array,
+        'normals': normals.array,
+        'triangles': corners.array[triangulate(counts.array.ravel())],
+    }
+
+
+def to_mesh(obj: Dict[str, np.array]) -> Mesh:
+    """Builds a mesh with one vertex per distinct combination of position,
+    texture coordinate and normal index"""
+    triangles = obj['triangles']  # (n, 3 corners, v/vt/vn)
+    corners = triangles.reshape(-1, 3)
+    # only use attributes that every corner has
+    attributes = [0] + [i for i in (1, 2) if len(corners) and (corners[:, i] >= 0).all()]
+    if attributes == [0]:
+        mesh = Mesh(obj['positions'], triangles[:, :, 0])
+    else:
+        # np.unique over rows is slow, combine the indices into one integer
+        used = corners[:, attributes]
+        sizes = used.max(axis=0) + 1
+        keys = np.ravel_multi_index(tuple(used.T), tuple(sizes))
+        unique, inverse = np.unique(keys, return_inverse=True)
+        unique = dict(zip(attributes, np.unravel_index(unique, tuple(sizes))))
+        mesh = Mesh(
+            obj['positions'][unique[0]],
+            inverse.reshape(-1, 3),
+            vertex_normals=obj['normals'][unique[2]] if 2 in unique else None,
+            texcoords=obj['texcoords'][unique[1]] if 1 in unique else None)
+    if mesh.vertex_normals is None:
+        mesh.compute_vertex_normals()
+    return mesh
+
+
+def cache_path(path: Path) -> Path:
+    return path.with_name(path.name + '.cache')
+
+
+def signature(path: Path) -> np.array:
+    stat = path.stat()
+    return np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns])
+
+
+def read_cache(path: Path) -> Optional[Mesh]:
+    """Memory maps the cached arrays, None if missing or stale"""
+    cache = cache_path(path)
+    try:
+        if not np.array_equal(np.load(str(cache / 'signature.npy')), signature(path)):
+            return None
+        arrays = {
+            f.stem: np.load(str(f), mmap_mode='r') for f in cache.glob('*.npy') if f.stem != 'signature'}
+        return Mesh(
+            arrays['vertices'], arrays['faces'],
+            vertex_normals=arrays['vertex_normals'], texcoords=arrays.get('texcoords'))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_cache(path: Path, mesh: Mesh) -> None:
+    """Writes raw .npy files next to the obj, silently gives up if the
+    directory is not writable or another process got there first"""
+    cache = cache_path(path)
+    try:
+        tmp = Path(tempfile.mkdtemp(prefix=cache.name, dir=str(path.parent)))
+    except OSError:
+        return
+    try:
+        np.save(str(tmp / 'vertices.npy'), mesh.vertices)
+        np.save(str(tmp / 'faces.npy'), mesh.faces)
+        np.save(str(tmp / 'vertex_normals.npy'), mesh.vertex_normals)
+        if mesh.texcoords is not None:
+            np.save(str(tmp / 'texcoords.npy'), mesh.texcoords)
+        # written last, marks the cache as complete
+        np.save(str(tmp / 'signature.npy'), signature(path))
+        if cache.exists():
+            shutil.rmtree(str(cache))
+        os.rename(str(tmp), str(cache))
+    except OSError:
+        shutil.rmtree(str(tmp), ignore_errors=True)
+
+
+def load_obj(path: Path, cache: bool = True) -> Mesh:
+    """Loads a triangulated mesh. With cache the parsed arrays are stored in a
+    binary sidecar directory and later loads memory map them."""
+    path = Path(path)
+    if cache:
+        mesh = read_cache(path)
+        if mesh is not None:
+            return mesh
 
-    mesh = Mesh(np.array(vertices), faces)
+    mesh = to_mesh(parse_obj(path))
+    if cache:
+        write_cache(path, mesh)
     return mesh
@@ -0,0 +1,229 @@
+"""Process metrics for the streaming servers, exposed in the Prometheus text
+format, and an on-demand sampling profiler"""
+from collections import Counter
+import math
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+BYTE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+
+# /profile is only served when this is set, it exposes the code of the worker
+PROFILING = os.environ.get('PROFILING', '') == '1'
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(n, v) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class HistogramChild:
+    """Counts of one label combination, cumulated when exposed"""
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        # buckets are few, a linear scan beats bisect here
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self) -> 'Timer':
+        return Timer(self)
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = TIME_BUCKETS, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(labels)
+        self.children = {}  # type: Dict[Tuple[str, ...], HistogramChild]
+        self._lock = threading.Lock()
+        if not labels:
+            self.children[()] = HistogramChild(self.buckets)
+        REGISTRY.append(self)
+
+    def labels(self, *values: str) -> HistogramChild:
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, HistogramChild(self.buckets))
+        return child
+
+    def observe(self, value: float) -> None:
+        self.children[()].observe(value)
+
+    def time(self) -> 'Timer':
+        return Timer(self.children[()])
+
+    def expose(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        for values, child in sorted(self.children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="{}"'.format('+Inf' if bound == math.inf else repr(bound))
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.label_names, values, le), cumulative))
+            labels = format_labels(self.label_names, values)
+            lines.append('{}_sum{} {!r}'.format(self.name, labels, total))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Gauge:
+    """A value that goes up and down, or is read from function when exposed"""
+    def __init__(self, name: str, description: str, function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.value = 0.0
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+    def expose(self) -> List[str]:
+        value = self.function() if self.function else self.value
+        return [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} gauge'.format(self.name),
+            '{} {!r}'.format(self.name, float(value)),
+        ]
+
+
+class Timer:
+    """Context manager observing the elapsed seconds"""
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child: HistogramChild):
+        self.child = child
+
+    def __enter__(self) -> 'Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.child.observe(time.perf_counter() - self.start)
+
+
+REGISTRY = []  # type: List
+
+
+def exposition() -> bytes:
+    """All metrics in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return ('\n'.join(lines) + '\n').encode()
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = Histogram(
+    'ascii_stage_seconds', 'Time spent in each stage of producing and sending a frame', labels=('stage',))
+FRAME_SECONDS = Histogram('ascii_frame_seconds', 'Time to produce a frame that was not cached, including queueing')
+LATENESS_SECONDS = Histogram(
+    'ascii_pacing_lateness_seconds', 'How far past its deadline a channel finished a frame, 0 when on time')
+WRITE_BYTES = Histogram('ascii_stream_write_bytes', 'Bytes written to a stream per frame', BYTE_BUCKETS)
+ACTIVE_STREAMS = Gauge('ascii_active_streams', 'Open /torus streams')
+DEGRADED_STREAMS = Gauge('ascii_degraded_streams', 'Streams paced below their requested parameters')
+GL_CONTEXTS = Gauge('ascii_gl_contexts', 'GL contexts created by this worker')
+
+
+def process_start() -> float:
+    """Unix time this process started, read from /proc where there is one,
+    else the time this module was imported"""
+    try:
+        with open('/proc/self/stat') as f:
+            # the command may contain spaces, fields are counted after it
+            fields = f.read().rpartition(')')[2].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        # the start is in clock ticks since boot
+        return time.time() - uptime + int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+class Startup:
+    """Seconds from the start of this worker until it was warm and until it
+    sent its first frame, and the time of each warm-up step"""
+    def __init__(self):
+        self.started = process_start()
+        self.warm = None  # type: Optional[float]
+        self.first_frame = None  # type: Optional[float]
+        self.steps = {}  # type: Dict[str, float]
+
+    def warmed(self, steps: Dict[str, float]) -> None:
+        self.steps.update(steps)
+        self.warm = time.time() - self.started
+
+    def frame_sent(self) -> None:
+        if self.first_frame is None:
+            self.first_frame = time.time() - self.started
+
+    def stats(self) -> Dict:
+        return {'warm_seconds': self.warm, 'first_frame_seconds': self.first_frame, 'steps': self.steps}
+
+
+startup = Startup()
+TIME_TO_WARM = Gauge(
+    'ascii_time_to_warm_seconds', 'Seconds from worker start until warmed up, 0 until then',
+    lambda: startup.warm or 0.0)
+TIME_TO_FIRST_FRAME = Gauge(
+    'ascii_time_to_first_frame_seconds', 'Seconds from worker start until its first frame was sent, 0 until then',
+    lambda: startup.first_frame or 0.0)
+
+
+_profiling = threading.Lock()
+
+
+def profile(seconds: float, interval: float = 0.005) -> Optional[str]:
+    """Samples the stacks of all threads for a while and returns them in the
+    collapsed format of flamegraph.pl, one 'thread;outer;...;inner count'
+    line per stack. None if a profile is already being taken."""
+    if not _profiling.acquire(blocking=False):
+        return None
+    try:
+        me = threading.get_ident()
+        names = {}  # type: Dict[int, str]
+        stacks = Counter()  # type: Counter
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for thread in threading.enumerate():
+                names.setdefault(thread.ident, thread.name)
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+    finally:
+        _profiling.release()
@@ -0,0 +1,139 @@
+"""Per connection pacing that follows how fast the client drains frames"""
+import fcntl
+import socket
+import struct
+import termios
+import time
+from typing import Callable, Generic, List, Optional, Tuple, TypeVar
+
+from metrics import DEGRADED_STREAMS
+
+T = TypeVar('T')
+
+# Kernel send buffer of stream connections. The kernel grows it to
+# megabytes for slow clients otherwise, hiding them from the pacer.
+SEND_BUFFER = 64 * 1024
+
+# Seconds to drain the queued bytes that count as a load of 1
+MAX_LATENCY = 0.5
+
+
+def limit_send_buffer(sock) -> None:
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+    except OSError:
+        pass
+
+
+def unsent_bytes(sock) -> Optional[int]:
+    """Bytes in the kernel send queue of sock, None where unsupported"""
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0\0\0\0'))[0]
+    except (OSError, ValueError):
+        return None
+
+
+class Connection:
+    """Measures how much of what was written to a client is still queued.
+    ASGI has no standard access to the connection, uvicorn binds send to an
+    object holding its transport."""
+    def __init__(self, sock=None, transport=None):
+        self.transport = transport
+        if sock is None and transport is not None:
+            sock = transport.get_extra_info('socket')
+        self.sock = sock
+        if sock is not None:
+            limit_send_buffer(sock)
+
+    @classmethod
+    def from_asgi(cls, send: Callable) -> 'Connection':
+        return cls(transport=getattr(getattr(send, '__self__', None), 'transport', None))
+
+    def unsent(self) -> Optional[int]:
+        if self.sock is None:
+            return None
+        queued = unsent_bytes(self.sock)
+        if queued is not None and self.transport is not None:
+            queued += self.transport.get_write_buffer_size()
+        return queued
+
+
+class Pacer(Generic[T]):
+    """Adapts the parameters of one stream to how fast its client drains
+    frames. The ladder holds the requested parameters followed by
+    progressively cheaper ones, each with an fps. Every written frame reports
+    how long the write blocked and, if known, how many bytes are still
+    queued. The load is the larger of the blocked fraction of the frame
+    period and the seconds the queued bytes take to drain at the measured
+    drain rate, over MAX_LATENCY. A smoothed load
+    above overload steps down the ladder and one below underload steps back
+    up, after hold seconds at the current step."""
+    def __init__(
+            self, ladder: List[T], overload: float = 0.75, underload: float = 0.3, hold: float = 2.0,
+            smoothing: float = 0.2, clock: Callable[[], float] = time.monotonic):
+        self.ladder = ladder
+        self.overload = overload
+        self.underload = underload
+        self.hold = hold
+        self.smoothing = smoothing
+        self.clock = clock
+        self.level = 0
+        self.load = 0.0
+        self.rate = None  # type: Optional[float]
+        self.changed_at = clock()
+        self._last = None  # type: Optional[Tuple[float, Optional[int]]]
+
+    @property
+    def params(self) -> T:
+        return self.ladder[self.level]
+
+    def record(self, nbytes: int, seconds: float, unsent: Optional[int] = None) -> bool:
+        """Records a written frame, True when the parameters changed"""
+        # drained is what was written minus what the queue grew by, frame
+        # sizes vary too much with deltas and compression to count frames
+        now = self.clock()
+        if self._last is not None:
+            then, queued = self._last
+            drained = nbytes - (unsent - queued if unsent is not None and queued is not None else 0)
+            if now > then:
+                rate = max(drained, 0) / (now - then)
+                self.rate = rate if self.rate is None else self.rate + self.smoothing * (rate - self.rate)
+        self._last = now, unsent
+
+        load = seconds * self.params.fps
+        if unsent and self.rate is not None:
+            # a client that drains nothing has an infinite load
+            load = max(load, unsent / self.rate / MAX_LATENCY if self.rate else float('inf'))
+        # capped so that the smoothed load stays finite and can recover
+        self.load += self.smoothing * (min(load, 1 / self.smoothing) - self.load)
+
+        held = now - self.changed_at
+        if self.load > self.overload and self.level + 1 < len(self.ladder) and held >= self.hold:
+            self._step(1)
+        elif self.load < self.underload and self.level > 0 and held >= 3 * self.hold:
+            # slower to recover than to back off, so that a stream on the
+            # edge does not flap
+            self._step(-1)
+        else:
+            return False
+        return True
+
+    def _step(self, direction: int) -> None:
+        if self.level == 0:
+            DEGRADED_STREAMS.inc()
+        self.level += direction
+        if self.level == 0:
+            DEGRADED_STREAMS.dec()
+        self.changed_at = self.clock()
+        self.load = (self.overload + self.underload) / 2
+
+    def close(self) -> None:
+        if self.level > 0:
+            DEGRADED_STREAMS.dec()
+            self.level = 0
+
+    def __enter__(self) -> 'Pacer[T]':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,103 @@
+"""Multi-core pygl. Targets live in shared memory and worker processes each
+rasterize a band of rows straight into them, only the triangles of a band
+are sent to its worker."""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from mesh import Mesh
+from pygl import Arena, Program, draw_triangles, resolution
+
+# (shared memory name, shape, dtype) of an array
+Spec = Tuple[str, Tuple[int, ...], str]
+
+# shared memory attached by this worker process
+_attached = {}  # type: Dict[str, shared_memory.SharedMemory]
+# scratch buffers of this worker process
+_arena = Arena()
+
+
+def attach(spec: Spec) -> np.array:
+    name, shape, dtype = spec
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+
+def draw_band(
+        target: Spec, z_buffer: Spec, rows: Tuple[int, int], triangles: np.array, fragment_shader,
+        varying: Dict[str, np.array], tile_size: int, occlusion: bool) -> Dict[str, int]:
+    """Runs in a worker"""
+    first, last = rows
+    return draw_triangles(
+        attach(target)[first:last], attach(z_buffer)[first:last], triangles, fragment_shader, varying,
+        tile_size, first_row=first, arena=_arena, occlusion=occlusion)
+
+
+class ParallelProgram(Program):
+    """Program that splits the target into horizontal bands rasterized in
+    worker processes. Targets and z buffers must be allocated with buffer()
+    so that the workers can write into them directly."""
+    def __init__(self, vertex_shader, fragment_shader, workers: Optional[int] = None, **kwargs):
+        super().__init__(vertex_shader, fragment_shader, **kwargs)
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.shared = {}  # type: Dict[int, Tuple[shared_memory.SharedMemory, Spec]]
+
+    def buffer(self, shape: Tuple[int, ...], dtype=np.float64) -> np.array:
+        """Returns a zeroed array in shared memory, valid until close()"""
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        array.fill(0)
+        self.shared[array.ctypes.data] = memory, (memory.name, tuple(shape), dtype.str)
+        return array
+
+    def spec(self, array: np.array) -> Spec:
+        entry = self.shared.get(array.ctypes.data)
+        if entry is None or entry[1][1] != array.shape:
+            raise ValueError('targets must be allocated with ParallelProgram.buffer()')
+        return entry[1]
+
+    def bands(self, height: int):
+        """Row ranges of about equal height, aligned to tiles"""
+        tiles = -(-height // self.tile_size)
+        per_band = -(-tiles // self.workers) * self.tile_size
+        return [(first, min(first + per_band, height)) for first in range(0, height, per_band)]
+
+    def render(self, target: np.array, z_buffer: np.array, mesh: Mesh, **uniforms):
+        target_spec, z_spec = self.spec(target), self.spec(z_buffer)
+        screen, varying = self.primitives(resolution(target), mesh, uniforms)
+        z_buffer.fill(np.inf)
+
+        top = screen[:, :, 1].min(axis=1)
+        bottom = screen[:, :, 1].max(axis=1)
+        jobs = []
+        for first, last in self.bands(len(target)):
+            # pixel rows y are covered when y0 <= y < y1, see bounding_boxes
+            overlaps = (bottom >= first) & (top < last)
+            jobs.append(self.executor.submit(
+                draw_band, target_spec, z_spec, (first, last), screen[overlaps], self.fragment_shader,
+                {k: v[overlaps] for k, v in varying.items()}, self.tile_size, self.occlusion))
+        # triangles spanning several bands are counted once per band
+        self.counts = {}
+        for job in jobs:
+            for name, count in job.result().items():
+                self.counts[name] = self.counts.get(name, 0) + count
+
+    def close(self):
+        self.executor.shutdown()
+        for memory, _ in self.shared.values():
+            memory.close()
+            memory.unlink()
+        self.shared.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,5 +1,6 @@
 import numpy as np
 from typing import Callable, Dict, Optional, Tuple
+import weakref
 
 from mesh import Mesh
 
@@ -11,9 +12,92 @@ def resolution(target: np.array) -> Resolution:
     return shape[1], shape[0]
 
 
+class Arena:
+    """Scratch buffers that are reused from frame to frame. Buffers are
+    looked up by name and only reallocated when a frame needs more than any
+    frame before, so steady state frames allocate next to nothing. Views
+    returned by take() are valid until the next take() of the same name."""
+    def __init__(self):
+        self._buffers = {}  # type: Dict[Tuple[str, np.dtype], np.array]
+        self.allocations = 0
+
+    def take(self, name: str, shape, dtype) -> np.array:
+        shape = shape if isinstance(shape, tuple) else (shape,)
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buffer = self._buffers.get((name, dtype))
+        if buffer is None or len(buffer) < size:
+            # grow geometrically so that slowly growing frames settle quickly
+            buffer = np.empty(size if buffer is None else max(size, 2 * len(buffer)), dtype=dtype)
+            self._buffers[name, dtype] = buffer
+            self.allocations += 1
+        return buffer[:size].reshape(shape)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+def gather(arena: Arena, name: str, a: np.array, indices: np.array) -> np.array:
+    """a[indices] in a scratch buffer"""
+    out = arena.take(name, indices.shape + a.shape[1:], a.dtype)
+    # without mode='raise' take does not buffer the output
+    np.take(a, indices, axis=0, out=out, mode='clip')
+    return out
+
+
 # helper for shaders
-def vec4(v3, scalar):
-    return np.hstack([v3, scalar * np.ones(shape=(len(v3), 1))])
+def vec4(v3, scalar, out: Optional[np.array] = None):
+    if out is None:
+        out = np.empty((len(v3), 4), dtype=np.result_type(v3, np.float32))
+    out[:, :3] = v3
+    out[:, 3] = scalar
+    return out
+
+
+class VertexStage:
+    """The work of the lighting vertex shaders in scratch buffers: positions
+    to clip space and Lambert shading of the normalized normals. Matrices
+    multiply column vectors like numgl. The inverse transpose of the model
+    view matrix, which transforms the normals, is only computed again when
+    the matrix changes. Use one per program."""
+    def __init__(self):
+        self.arena = Arena()
+        self._model_view = None  # type: Optional[np.array]
+        self._normal_matrix = None  # type: Optional[np.array]
+
+    def normal_matrix(self, model_view: np.array) -> np.array:
+        """Inverse transpose of the rotation and scale of an affine matrix"""
+        if self._model_view is None or not np.array_equal(self._model_view, model_view):
+            self._model_view = np.array(model_view)
+            self._normal_matrix = np.linalg.inv(self._model_view[:3, :3]).T
+        return self._normal_matrix
+
+    def positions(self, mvp: np.array, positions_in: np.array) -> np.array:
+        """(n, 4) positions in homogeneous clip space"""
+        mvp = np.asarray(mvp, dtype=positions_in.dtype)
+        out = self.arena.take('positions', (len(positions_in), 4), positions_in.dtype)
+        np.matmul(positions_in, mvp[:, :3].T, out=out)
+        np.add(out, mvp[:, 3], out=out)
+        return out
+
+    def lambert(self, model_view: np.array, normals_in: np.array, light: np.array, ambient: float) -> np.array:
+        """clip(dot(normal, light), 0, 1) + ambient of every vertex, the light
+        is a normalized direction"""
+        n, dtype = len(normals_in), normals_in.dtype
+        normals = self.arena.take('normals', (n, 3), dtype)
+        np.matmul(normals_in, self.normal_matrix(model_view).T.astype(dtype), out=normals)
+        length = self.arena.take('length', n, dtype)
+        np.einsum('ij,ij->i', normals, normals, out=length)
+        np.sqrt(length, out=length)
+        # zero normals, e.g. of degenerate faces, stay zero
+        np.maximum(length, np.finfo(dtype).tiny, out=length)
+        intensity = self.arena.take('intensity', n, dtype)
+        np.matmul(normals, np.asarray(light, dtype=dtype), out=intensity)
+        np.divide(intensity, length, out=intensity)
+        np.clip(intensity, 0, 1, out=intensity)
+        np.add(intensity, ambient, out=intensity)
+        return intensity
 
 
 def edge_function(p0, p1, p2):
@@ -61,7 +145,7 @@ def get_screen(clip: np.array, r: Resolution) -> np.array:
 
 
 def extend(vertices: np.array) -> np.array:
-    return np.hstack([vertices, np.ones((len(vertices), 1))])
+    return vec4(vertices, 1)
 
 
 def to_clip(points: np.array) -> np.array:
@@ -131,21 +215,480 @@ def draw_triangle(
     z_buffer[yy, xx] = z[zok]
 
 
+TILE_SIZE = 8
+TILE_BATCH = 2048  # (triangle, tile) pairs rasterized per pass
+OCCLUSION_BATCH = 8 * TILE_BATCH  # most pairs drawn between depth pyramid updates
+
+
+def bounding_boxes(triangles: np.array, r: Resolution, arena: Optional[Arena] = None) -> Tuple[np.array, ...]:
+    '''Pixel bounding boxes of the triangles, [x0, x1) x [y0, y1), computed the
+       same way as in draw_triangle but clamped to the target'''
+    width, height = r
+    arena = Arena() if arena is None else arena
+    n = len(triangles)
+    lo = arena.take('bounds.lo', (n, 2), triangles.dtype)
+    hi = arena.take('bounds.hi', (n, 2), triangles.dtype)
+    np.min(triangles[:, :, :2], axis=1, out=lo)
+    np.max(triangles[:, :, :2], axis=1, out=hi)
+    x0, x1, y0, y1 = [arena.take('bounds.' + name, n, np.int64) for name in ('x0', 'x1', 'y0', 'y1')]
+    # copying to integers truncates towards zero just like int() does
+    for low, high, limit, column in ((x0, x1, width, 0), (y0, y1, height, 1)):
+        np.maximum(lo[:, column], 0, out=lo[:, column])
+        np.copyto(low, lo[:, column], casting='unsafe')
+        np.minimum(hi[:, column], limit, out=hi[:, column])
+        np.copyto(high, hi[:, column], casting='unsafe')
+        np.add(high, 1, out=high)
+        np.minimum(high, limit, out=high)
+    return x0, x1, y0, y1
+
+
+def bin_triangles(x0, x1, y0, y1, tile_size: int) -> Tuple[np.array, np.array, np.array]:
+    '''Lists every (triangle, tile) pair where the triangle bounding box
+       overlaps the tile. Pairs are ordered by triangle index.'''
+    tx0, ty0 = x0 // tile_size, y0 // tile_size
+    ntx = np.maximum((x1 - 1) // tile_size + 1 - tx0, 0)
+    nty = np.maximum((y1 - 1) // tile_size + 1 - ty0, 0)
+    counts = ntx * nty
+    tri = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return tri, tx0[tri] + local % ntx[tri], ty0[tri] + local // ntx[tri]
+
+
+def barycentric(triangles: np.array, area: np.array, x: np.array, y: np.array) -> Tuple[np.array, ...]:
+    '''Barycentric coordinates of the points (x, y), one point per triangle.
+       Evaluates the edge functions in the same order of operations as edge()
+       so the result is bit identical to draw_triangle.'''
+    (x0, y0), (x1, y1), (x2, y2) = [triangles[:, i, :2].T for i in range(3)]
+    w0 = (x - x1) * (y2 - y1) - (y - y1) * (x2 - x1)
+    w1 = (x - x2) * (y0 - y2) - (y - y2) * (x0 - x2)
+    w2 = (x - x0) * (y1 - y0) - (y - y0) * (x1 - x0)
+    return w0 / area, w1 / area, w2 / area
+
+
+def interpolate(b: Tuple[np.array, ...], v: np.array) -> np.array:
+    b0, b1, b2 = b
+    return b0 * v[:, 0] + b1 * v[:, 1] + b2 * v[:, 2]
+
+
+def barycentric_into(
+        arena: Arena, name: str, triangles: np.array, area: np.array, t: np.array, x: np.array,
+        y: np.array) -> Tuple[np.array, ...]:
+    '''barycentric() of the points (x, y) in triangles[t] and scratch buffers,
+       with the same order of operations'''
+    n, dtype = len(t), triangles.dtype
+    xy = [[gather(arena, '{}.v{}{}'.format(name, i, j), triangles[:, i, j], t) for j in (0, 1)] for i in range(3)]
+    a, b = arena.take(name + '.a', n, dtype), arena.take(name + '.b', n, dtype)
+    out = []
+    for i, ((xa, ya), (xb, yb)) in enumerate(((xy[1], xy[2]), (xy[2], xy[0]), (xy[0], xy[1]))):
+        # (x - xa) * (yb - ya) - (y - ya) * (xb - xa)
+        w = arena.take('{}.w{}'.format(name, i), n, dtype)
+        np.subtract(x, xa, out=w)
+        np.subtract(yb, ya, out=a)
+        np.multiply(w, a, out=w)
+        np.subtract(y, ya, out=a)
+        np.subtract(xb, xa, out=b)
+        np.multiply(a, b, out=a)
+        np.subtract(w, a, out=w)
+        out.append(w)
+    area = gather(arena, name + '.area', area, t)
+    for w in out:
+        np.divide(w, area, out=w)
+    return tuple(out)
+
+
+def interpolate_into(arena: Arena, name: str, b: Tuple[np.array, ...], v: np.array, t: np.array) -> np.array:
+    '''interpolate() of v[t] in a scratch buffer'''
+    out = arena.take(name, (len(t),) + v.shape[2:], v.dtype)
+    term = arena.take(name + '.term', out.shape, v.dtype)
+    for i, bi in enumerate(b):
+        vi = gather(arena, name + '.v', v[:, i], t)
+        bi = bi.reshape(bi.shape + (1,) * (vi.ndim - 1))
+        np.multiply(bi, vi, out=out if i == 0 else term)
+        if i:
+            np.add(out, term, out=out)
+    return out
+
+
+def select(arena: Arena, name: str, mask: np.array, *arrays: np.array) -> Tuple[np.array, ...]:
+    '''The rows of each array where mask is set, in scratch buffers'''
+    keep = np.flatnonzero(mask)
+    return tuple(gather(arena, '{}{}'.format(name, i), a, keep) for i, a in enumerate(arrays))
+
+
+class DepthPyramid:
+    '''Max depth of every tile of a depth buffer and coarser levels, each the
+       max of 2 x 2 cells of the one below. A triangle farther away than the
+       max depth of every cell it overlaps is hidden. Uncovered pixels are at
+       infinity, so only fully covered areas can hide anything.'''
+    def __init__(self, arena: Arena, depth: np.array, tile_size: int):
+        self.depth = depth  # padded to whole tiles, padding at -inf
+        self.tile_size = tile_size
+        rows, columns = depth.shape[0] // tile_size, depth.shape[1] // tile_size
+        self.levels = []
+        while True:
+            self.levels.append(arena.take('pyramid{}'.format(len(self.levels)), (rows, columns), depth.dtype))
+            if rows == 1 and columns == 1:
+                break
+            rows, columns = (rows + 1) // 2, (columns + 1) // 2
+
+    def update(self, tile_x: Optional[np.array] = None, tile_y: Optional[np.array] = None) -> None:
+        """Updates the given tiles, all by default, and the levels above"""
+        tiles = self.levels[0]
+        rows, columns = tiles.shape
+        blocks = self.depth.reshape(rows, self.tile_size, columns, self.tile_size)
+        if tile_x is None:
+            np.max(blocks, axis=(1, 3), out=tiles)
+        else:
+            tile_y, tile_x = np.divmod(np.unique(tile_y * columns + tile_x), columns)
+            tiles[tile_y, tile_x] = blocks[tile_y, :, tile_x, :].max(axis=(1, 2))
+        for below, level in zip(self.levels, self.levels[1:]):
+            level.fill(-np.inf)
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    part = below[dy::2, dx::2]
+                    cells = level[:part.shape[0], :part.shape[1]]
+                    np.maximum(cells, part, out=cells)
+
+    def hidden(self, near: np.array, tx0: np.array, tx1: np.array, ty0: np.array, ty1: np.array) -> np.array:
+        '''Whether triangles with the nearest depths near and overlapping the
+           tiles [tx0, tx1] x [ty0, ty1] are hidden. Each triangle is tested
+           at the level where its tiles fall into at most 2 x 2 cells.'''
+        span = np.maximum(np.maximum(tx1 - tx0, ty1 - ty0), 0)
+        # the smallest level with cells of more than span tiles
+        level = np.minimum(np.ceil(np.log2(span + 1)).astype(np.int64), len(self.levels) - 1)
+        farthest = np.full(len(near), -np.inf, dtype=near.dtype)
+        for i in np.unique(level).tolist():
+            at, cells = np.flatnonzero(level == i), self.levels[i]
+            rows = [np.clip(ty[at] >> i, 0, cells.shape[0] - 1) for ty in (ty0, ty1)]
+            columns = [np.clip(tx[at] >> i, 0, cells.shape[1] - 1) for tx in (tx0, tx1)]
+            for row in rows:
+                for column in columns:
+                    farthest[at] = np.maximum(farthest[at], cells[row, column])
+        return near > farthest
+
+    def hidden_tiles(self, near: np.array, tile_x: np.array, tile_y: np.array) -> np.array:
+        return near > self.levels[0][tile_y, tile_x]
+
+
+def draw_triangles(
+        target: np.array,
+        z_buffer: np.array,
+        triangles: np.array,  # n x 3 vertices
+        fragment_shader: Callable,
+        varying: Dict[str, np.array],  # n x 3 per attribute
+        tile_size: int = TILE_SIZE,
+        first_row: int = 0,
+        arena: Optional[Arena] = None,
+        occlusion: bool = True) -> Dict[str, int]:
+    '''Rasterizes all triangles in batches. Triangles are binned into screen
+       tiles and the edge functions are tested for all (triangle, tile) pairs
+       of a batch at once. Depth is resolved per pixel keeping the first
+       triangle with the smallest z, which is what calling draw_triangle for
+       each triangle in order does. The fragment shader runs once per frame on
+       the surviving fragments. The target may be a band of rows of the
+       screen starting at first_row. Intermediate arrays live in the arena,
+       pass the same one every frame so that they are reused.
+
+       With occlusion, triangles are drawn nearest first and a DepthPyramid
+       of what has been drawn is updated between batches. Triangles and
+       tiles that it hides are skipped before any per pixel work.
+
+       Returns counts of triangles, hidden triangles, (triangle, tile) pairs,
+       hidden pairs and fragments that were depth tested.'''
+    arena = Arena() if arena is None else arena
+    width, height = resolution(target)
+    n, dtype = len(triangles), triangles.dtype
+    (x0, y0), (x1, y1), (x2, y2) = [triangles[:, i, :2].T for i in range(3)]
+    # (x2 - x0) * (y1 - y0) - (y2 - y0) * (x1 - x0)
+    area, a, b = [arena.take('raster.' + name, n, dtype) for name in ('area', 'a', 'b')]
+    np.subtract(x2, x0, out=area)
+    np.subtract(y1, y0, out=a)
+    np.multiply(area, a, out=area)
+    np.subtract(y2, y0, out=a)
+    np.subtract(x1, x0, out=b)
+    np.multiply(a, b, out=a)
+    np.subtract(area, a, out=area)
+
+    finite = arena.take('raster.finite', triangles.shape, bool)
+    ok, nonzero = arena.take('raster.ok', n, bool), arena.take('raster.nonzero', n, bool)
+    np.isfinite(triangles, out=finite)
+    np.all(finite, axis=(1, 2), out=ok)
+    np.not_equal(area, 0, out=nonzero)
+    np.logical_and(ok, nonzero, out=ok)
+    if not ok.all():
+        keys = list(varying)
+        triangles, area, *values = select(arena, 'raster.ok', ok, triangles, area, *varying.values())
+        varying = dict(zip(keys, values))
+    counts = {'triangles': len(triangles), 'hidden_triangles': 0, 'pairs': 0, 'hidden_pairs': 0, 'fragments': 0}
+
+    x0, x1, y0, y1 = bounding_boxes(triangles, (width, first_row + height), arena)
+    np.maximum(y0, first_row, out=y0)
+
+    # depth and triangle of every pixel of whole tiles, the first tile row
+    # may start above first_row
+    top = first_row // tile_size * tile_size
+    rows = -(-(first_row + height - top) // tile_size) * tile_size
+    columns = -(-width // tile_size) * tile_size
+    best_z = arena.take('raster.best_z', (rows, columns), z_buffer.dtype)
+    best_z.fill(-np.inf)
+    best_z[first_row - top:first_row - top + height, :width] = z_buffer
+    best_tri = arena.take('raster.best_tri', (rows, columns), np.int64)
+    best_tri.fill(-1)
+    best_z, best_tri = best_z.reshape(-1), best_tri.reshape(-1)
+    pyramid = DepthPyramid(arena, best_z.reshape(rows, columns), tile_size)
+    if occlusion:
+        # the z buffer may already hold something that hides triangles
+        pyramid.update()
+    near = arena.take('raster.near', len(triangles), dtype)
+    np.min(triangles[:, :, 2], axis=1, out=near)
+    order = np.argsort(near, kind='stable') if occlusion else np.arange(len(triangles))
+
+    oy, ox = np.divmod(np.arange(tile_size * tile_size), tile_size)
+
+    def rasterize(pairs: np.array, tile_x: np.array, tile_y: np.array):
+        shape = len(pairs), tile_size * tile_size
+        t = arena.take('raster.t', shape, np.int64)
+        x = arena.take('raster.x', shape, np.int64)
+        y = arena.take('raster.y', shape, np.int64)
+        np.copyto(t, pairs[:, None])
+        np.add((tile_x * tile_size)[:, None], ox, out=x)
+        np.add((tile_y * tile_size)[:, None], oy, out=y)
+        in_box, test = arena.take('raster.in_box', shape, bool), arena.take('raster.test', shape, bool)
+        np.greater_equal(x, x0[pairs][:, None], out=in_box)
+        for coordinate, compare, bound in ((x, np.less, x1), (y, np.greater_equal, y0), (y, np.less, y1)):
+            compare(coordinate, bound[pairs][:, None], out=test)
+            np.logical_and(in_box, test, out=in_box)
+        t, x, y = select(arena, 'raster.box', in_box.ravel(), t.ravel(), x.ravel(), y.ravel())
+
+        xf, yf = arena.take('raster.xf', len(x), dtype), arena.take('raster.yf', len(y), dtype)
+        np.copyto(xf, x, casting='unsafe')
+        np.copyto(yf, y, casting='unsafe')
+        b0, b1, b2 = barycentric_into(arena, 'raster.b', triangles, area, t, xf, yf)
+        is_inside, test = arena.take('raster.inside', len(t), bool), arena.take('raster.test', len(t), bool)
+        np.greater_equal(b0, 0, out=is_inside)
+        for bi in (b1, b2):
+            np.greater_equal(bi, 0, out=test)
+            np.logical_and(is_inside, test, out=is_inside)
+        t, x, y, b0, b1, b2 = select(arena, 'raster.inside', is_inside, t, x, y, b0, b1, b2)
+        counts['fragments'] += len(t)
+        z = interpolate_into(arena, 'raster.z', (b0, b1, b2), triangles[:, :, 2], t)
+
+        # pixel = (y - top) * columns + x
+        pixel = y
+        np.subtract(y, top, out=pixel)
+        np.multiply(pixel, columns, out=pixel)
+        np.add(pixel, x, out=pixel)
+        # nearer, or as near and drawn earlier without occlusion
+        old_z = gather(arena, 'raster.old_z', best_z, pixel)
+        zok, test = arena.take('raster.zok', len(pixel), bool), arena.take('raster.test', len(pixel), bool)
+        np.greater(old_z, z, out=zok)
+        np.equal(old_z, z, out=test)
+        np.logical_and(test, gather(arena, 'raster.old_tri', best_tri, pixel) > t, out=test)
+        np.logical_or(zok, test, out=zok)
+        pixel, z, t = select(arena, 'raster.zok', zok, pixel, z, t)
+
+        # the lowest triangle index comes first among equal z
+        order = np.lexsort((t, z, pixel))
+        pixel, z, t = [gather(arena, 'raster.sorted{}'.format(i), v, order) for i, v in enumerate((pixel, z, t))]
+        first = arena.take('raster.first', len(pixel), bool)
+        first[:1] = True
+        np.not_equal(pixel[1:], pixel[:-1], out=first[1:])
+        pixel, z, t = select(arena, 'raster.first', first, pixel, z, t)
+        best_z[pixel] = z
+        best_tri[pixel] = t
+
+    # chunks of triangles nearest first, small at first while the nearest
+    # triangles fill the pyramid. Without occlusion there is one chunk.
+    tx0, ty0 = x0 // tile_size, y0 // tile_size
+    tx1, ty1 = (x1 - 1) // tile_size, (y1 - 1) // tile_size
+    ends = np.cumsum((np.maximum(tx1 - tx0 + 1, 0) * np.maximum(ty1 - ty0 + 1, 0))[order])
+    start, budget = 0, TILE_BATCH if occlusion else len(order) and int(ends[-1])
+    while start < len(order):
+        base = ends[start - 1] if start else 0
+        stop = max(int(np.searchsorted(ends, base + budget, side='right')), start + 1)
+        budget = min(2 * budget, OCCLUSION_BATCH)
+        chunk = order[start:stop]
+        if occlusion:
+            hidden = pyramid.hidden(near[chunk], tx0[chunk], tx1[chunk], ty0[chunk] - top // tile_size,
+                                    ty1[chunk] - top // tile_size)
+            counts['hidden_triangles'] += int(np.count_nonzero(hidden))
+            chunk = chunk[~hidden]
+        start = stop
+
+        tri, tile_x, tile_y = bin_triangles(x0[chunk], x1[chunk], y0[chunk], y1[chunk], tile_size)
+        tri = chunk[tri]
+        counts['pairs'] += len(tri)
+        if occlusion:
+            hidden = pyramid.hidden_tiles(near[tri], tile_x, tile_y - top // tile_size)
+            counts['hidden_pairs'] += int(np.count_nonzero(hidden))
+            tri, tile_x, tile_y = tri[~hidden], tile_x[~hidden], tile_y[~hidden]
+        for batch in range(0, len(tri), TILE_BATCH):
+            end = batch + TILE_BATCH
+            rasterize(tri[batch:end], tile_x[batch:end], tile_y[batch:end])
+        if occlusion:
+            pyramid.update(tile_x, tile_y - top // tile_size)
+
+    covered = arena.take('raster.covered', len(best_tri), bool)
+    np.greater_equal(best_tri, 0, out=covered)
+    pixel = np.flatnonzero(covered)
+    if not len(pixel):
+        return counts
+    t = gather(arena, 'raster.t', best_tri, pixel)
+    yy, xx = arena.take('raster.yy', len(pixel), np.int64), arena.take('raster.xx', len(pixel), np.int64)
+    np.divmod(pixel, columns, out=(yy, xx))
+    xf, yf = arena.take('raster.xf', len(pixel), dtype), arena.take('raster.yf', len(pixel), dtype)
+    np.copyto(xf, xx, casting='unsafe')
+    np.add(yy, top, out=yy)
+    np.copyto(yf, yy, casting='unsafe')
+    b = barycentric_into(arena, 'raster.b', triangles, area, t, xf, yf)
+
+    # Interpolate vertex attributes
+    interpolated = {k: interpolate_into(arena, 'raster.varying.' + k, b, v, t) for k, v in varying.items()}
+
+    # Fill pixels
+    np.subtract(yy, first_row, out=yy)
+    color = np.asarray(fragment_shader(interpolated))
+    color = color.reshape((-1,) + target.shape[2:])
+    clipped = arena.take('raster.color', color.shape, color.dtype)
+    np.clip(color, 0, 1, out=clipped)
+    target[yy, xx] = clipped
+    z_buffer[yy, xx] = gather(arena, 'raster.old_z', best_z, pixel)
+    return counts
+
+
+def outside_frustum(triangles: np.array) -> np.array:
+    '''Triangles in homogeneous clip space with all vertices outside the same
+       side or near plane of the view frustum, they can not cover any pixel.
+       The far plane has never been enforced, depth beyond it is still
+       ordered by the z buffer.'''
+    xy, z, w = triangles[:, :, :2], triangles[:, :, 2], triangles[:, :, 3:]
+    sides = ((xy < -w).all(axis=1) | (xy > w).all(axis=1)).any(axis=1)
+    return sides | (z < -w[:, :, 0]).all(axis=1)
+
+
+def lerp(a: np.array, b: np.array, t: np.array) -> np.array:
+    return a + (b - a) * t.reshape(t.shape + (1,) * (a.ndim - 1))
+
+
+def clip_near(triangles: np.array, varying: Dict[str, np.array]) -> Tuple[np.array, Dict[str, np.array]]:
+    '''Clips triangles in homogeneous clip space against the near plane
+       z = -w. Triangles with one vertex in front become a smaller triangle,
+       with two a quad split into two triangles. Winding is kept. Triangles
+       entirely behind the plane must already be rejected.'''
+    distance = triangles[:, :, 2] + triangles[:, :, 3]
+    inside = distance >= 0
+    count = inside.sum(axis=1)
+    if (count == 3).all():
+        return triangles, varying
+
+    # rotate each clipped triangle, keeping the winding, so that the vertex
+    # alone on its side comes first (one inside) or last (two inside)
+    one, two = np.flatnonzero(count == 1), np.flatnonzero(count == 2)
+    first = np.concatenate([np.argmax(inside[one], axis=1), np.argmin(inside[two], axis=1) + 1])
+    clipped = np.concatenate([one, two])
+    order = (first[:, None] + np.arange(3)) % 3
+    rows = clipped[:, None]
+    d0, d1, d2 = distance[rows, order].T
+
+    def split(v: np.array) -> np.array:
+        v0, v1, v2 = [v[clipped, order[:, i]] for i in range(3)]
+        n = len(one)
+        # one inside: v0 and the crossings of edges v0v1 and v0v2
+        a = lerp(v0[:n], v1[:n], d0[:n] / (d0[:n] - d1[:n]))
+        b = lerp(v0[:n], v2[:n], d0[:n] / (d0[:n] - d2[:n]))
+        # two inside: v0, v1 and the crossings of edges v1v2 and v2v0
+        c = lerp(v1[n:], v2[n:], d1[n:] / (d1[n:] - d2[n:]))
+        d = lerp(v2[n:], v0[n:], d2[n:] / (d2[n:] - d0[n:]))
+        return np.concatenate([
+            v[count == 3],
+            np.stack([v0[:n], a, b], axis=1),
+            np.stack([v0[n:], v1[n:], c], axis=1),
+            np.stack([v0[n:], c, d], axis=1)])
+
+    return split(triangles), {k: split(v) for k, v in varying.items()}
+
+
+def front_facing(triangles: np.array) -> np.array:
+    '''Counter clockwise triangles in normalized device coordinates, which
+       are clockwise on screen where y points down'''
+    (x0, y0), (x1, y1), (x2, y2) = [triangles[:, i, :2].T for i in range(3)]
+    return (x2 - x0) * (y1 - y0) - (y2 - y0) * (x1 - x0) > 0
+
+
 class Program:
-    def __init__(self, vertex_shader, fragment_shader):
+    """Renders meshes with a vertex and a fragment shader written with numpy.
+    With a dtype, float32 for example, meshes and uniform arrays are
+    converted to it and the whole pipeline runs in it. Intermediate arrays
+    are kept in an arena and reused from frame to frame. With occlusion,
+    triangles hidden by nearer ones are skipped, see draw_triangles. The
+    counts of the last frame are kept in counts."""
+    def __init__(
+            self, vertex_shader, fragment_shader, tile_size: int = TILE_SIZE, cull_back_faces: bool = True,
+            dtype=None, occlusion: bool = True):
         self.vertex_shader = vertex_shader
         self.fragment_shader = fragment_shader
+        self.tile_size = tile_size
+        self.cull_back_faces = cull_back_faces
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.occlusion = occlusion
+        self.counts = {}  # type: Dict[str, int]
+        self.arena = Arena()
+        self._inputs = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary[Mesh, Tuple[np.array, np.array]]
 
     def render(self, target: np.array, z_buffer: np.array, mesh: Mesh, **uniforms):
-        positions, outputs = self.vertex_shader(mesh.vertices, mesh.vertex_normals, uniforms)
-        screen = get_screen(to_clip(positions), resolution(target))
+        screen, varying = self.primitives(resolution(target), mesh, uniforms)
         z_buffer.fill(np.inf)
-
-        for face in mesh.faces:
-            varying = {k: v[face] for k, v in outputs.items()}
-            draw_triangle(
-                target,
-                z_buffer,
-                screen[face],
-                self.fragment_shader,
-                varying)
+        self.counts = draw_triangles(
+            target,
+            z_buffer,
+            screen,
+            self.fragment_shader,
+            varying,
+            self.tile_size,
+            arena=self.arena,
+            occlusion=self.occlusion)
+
+    def inputs(self, mesh: Mesh) -> Tuple[np.array, np.array]:
+        """Vertices and vertex normals, converted once per mesh"""
+        if self.dtype is None:
+            return mesh.vertices, mesh.vertex_normals
+        inputs = self._inputs.get(mesh)
+        if inputs is None:
+            inputs = self._inputs[mesh] = (
+                np.ascontiguousarray(mesh.vertices, dtype=self.dtype),
+                np.ascontiguousarray(mesh.vertex_normals, dtype=self.dtype))
+        return inputs
+
+    def primitives(self, r: Resolution, mesh: Mesh, uniforms: Dict) -> Tuple[np.array, Dict[str, np.array]]:
+        '''Runs the vertex shader and returns the screen space triangles left
+           to rasterize with their varyings, valid until the next call'''
+        if self.dtype is not None:
+            uniforms = {k: np.asarray(v, dtype=self.dtype) if isinstance(v, np.ndarray) else v
+                        for k, v in uniforms.items()}
+        positions, outputs = self.vertex_shader(*self.inputs(mesh), uniforms)
+        if self.dtype is not None:
+            positions = positions.astype(self.dtype, copy=False)
+
+        # classify the faces in clip space before anything is rasterized
+        arena = self.arena
+        faces = np.asarray(mesh.faces)
+        triangles = gather(arena, 'triangles', positions, faces)
+        keys = list(outputs)
+        values = [gather(arena, 'varying.' + k, v, faces) for k, v in outputs.items()]
+        visible = ~outside_frustum(triangles)
+        if not visible.all():
+            triangles, *values = select(arena, 'visible', visible, triangles, *values)
+        triangles, varying = clip_near(triangles, dict(zip(keys, values)))
+
+        # get_screen(to_clip(triangles))
+        width, height = r
+        screen = arena.take('screen', (len(triangles), 3, 3), triangles.dtype)
+        np.divide(triangles[:, :, :3], triangles[:, :, 3:], out=screen)
+        np.multiply(screen, np.array([width / 2, -height / 2, 1], dtype=screen.dtype), out=screen)
+        np.add(screen, np.array([width / 2, height / 2, 0], dtype=screen.dtype), out=screen)
+        if self.cull_back_faces:
+            front = front_facing(screen)
+            if not front.all():
+                screen, *values = select(arena, 'front', front, screen, *varying.values())
+                varying = dict(zip(keys, values))
+        return screen, varying
@@ -1,15 +1,33 @@
+from collections import OrderedDict
+import functools
 import io
 import json
 from pathlib import Path
-from typing import BinaryIO, Dict, List, Tuple
+from typing import BinaryIO, Callable, Dict, List, Optional, Set, Tuple
+import weakref
 
 import numpy as np
 import moderngl
 
+import ascii
+from lod import lod_chain
 from mesh import Mesh
+from metrics import STAGE_SECONDS
 
 
+# Frames drawn by one call in Renderer.luminance_batch
+MAX_BATCH = 64
+
+GL_CLIP_DISTANCE0 = 0x3000
+
+# (vertex shader, fragment shader) of the programs of Renderer
+SIMPLE = 'shaders/simple.vert', 'shaders/simple.frag'
+QUANTIZE = 'shaders/quad.vert', 'shaders/quantize.frag'
+BATCH = 'shaders/batch.vert', 'shaders/simple.frag'
+PROGRAMS = SIMPLE, QUANTIZE, BATCH
+
 Size = Tuple[int, int]
+Scene = Tuple[np.array, np.array]  # camera, light1
 
 
 def to_vaocontent(ctx: moderngl.Context, pos_data, normal_data, uv_data) -> List[moderngl.Buffer]:
@@ -24,11 +42,12 @@ def get_aspect(size: Size) -> float:
     return width / height
 
 
-def create_fbo(ctx: moderngl.Context, size: Size, components: int = 4) -> moderngl.Framebuffer:
+def create_fbo(ctx: moderngl.Context, size: Size, components: int = 4, texture: bool = False) -> moderngl.Framebuffer:
     """Create a Frame Buffer Object (fbo) with the given size and
-    color components"""
+    color components. With texture the color can be sampled by shaders."""
+    color = ctx.texture(size, components) if texture else ctx.renderbuffer(size, components)
     return ctx.framebuffer(
-        color_attachments=[ctx.renderbuffer(size, components)],
+        color_attachments=[color],
         depth_attachment=ctx.depth_renderbuffer(size))
 
 
@@ -48,45 +67,318 @@ def from_mesh(ctx: moderngl.Context, program: moderngl.Program, mesh: Mesh):
     #)
 
 def pack(mesh: Mesh) -> np.array:
-    rows = []
-    for i0, i1, i2 in mesh.faces:
-        rows.append(np.hstack([mesh.vertices[i0], mesh.vertex_normals[i0]]))
-        rows.append(np.hstack([mesh.vertices[i1], mesh.vertex_normals[i1]]))
-        rows.append(np.hstack([mesh.vertices[i2], mesh.vertex_normals[i2]]))
+    """Interleaved position and normal of the three vertices of every face"""
+    interleaved = np.hstack([mesh.vertices, mesh.vertex_normals])
+    return interleaved[np.asarray(mesh.faces).ravel()]
+
+
+class ResourcePool:
+    """GL resources shared by renderers on one context: compiled programs,
+    vertex arrays per mesh, framebuffers per size and pixel buffers per
+    renderer. All but programs are evicted least recently used first and
+    released."""
+    def __init__(
+            self, ctx: moderngl.Context, max_vertex_arrays: int = 16, max_framebuffers: int = 16,
+            max_pixel_buffers: int = 16):
+        self.ctx = ctx
+        self.max_vertex_arrays = max_vertex_arrays
+        self.max_framebuffers = max_framebuffers
+        self.max_pixel_buffers = max_pixel_buffers
+        self.programs = {}  # type: Dict[Tuple[str, str], moderngl.Program]
+        self.quads = {}  # type: Dict[int, moderngl.VertexArray]
+        self.vertex_arrays = OrderedDict()  # type: OrderedDict[Tuple[int, Mesh], Tuple[moderngl.VertexArray, Tuple[moderngl.Buffer, ...]]]
+        self.framebuffers = OrderedDict()  # type: OrderedDict[Tuple[Size, int, bool], moderngl.Framebuffer]
+        self.pixel_buffers = OrderedDict()  # type: OrderedDict[Tuple[int, int], Tuple[moderngl.Buffer, ...]]
+        # ids of owners with pixel buffers, and of owners that died since,
+        # whose buffers are released on the GL thread by the next call
+        self._owners = set()  # type: Set[int]
+        self._dead_owners = []  # type: List[int]
+
+    def program(self, vertex_shader: str, fragment_shader: str) -> moderngl.Program:
+        key = vertex_shader, fragment_shader
+        if key not in self.programs:
+            self.programs[key] = self.ctx.program(
+                vertex_shader=Path(vertex_shader).read_text(),
+                fragment_shader=Path(fragment_shader).read_text())
+        return self.programs[key]
+
+    def vertex_array(self, program: moderngl.Program, mesh: Mesh) -> moderngl.VertexArray:
+        """Meshes are compared by identity, re-use the mesh object to share"""
+        return self._vertex_array(program, mesh, 0)[0]
+
+    def instanced_vertex_array(
+            self, program: moderngl.Program, mesh: Mesh, instances: int) -> Tuple[moderngl.VertexArray, moderngl.Buffer]:
+        """Vertex array with a model view matrix per instance (in_modelView),
+        read from the returned buffer which holds up to instances matrices"""
+        vao, buffers = self._vertex_array(program, mesh, instances)
+        return vao, buffers[1]
 
-    return np.vstack(rows).copy('C')
+    def _vertex_array(self, program: moderngl.Program, mesh: Mesh, instances: int):
+        key = program.glo, mesh
+        if key in self.vertex_arrays:
+            self.vertex_arrays.move_to_end(key)
+            return self.vertex_arrays[key]
+        vertex_data = pack(mesh).astype('f4').tobytes()
+        vbo = self.ctx.buffer(vertex_data)
+        if instances:
+            matrices = self.ctx.buffer(reserve=instances * 16 * 4)
+            vao = self.ctx.vertex_array(
+                program, [(vbo, '3f 3f', 'in_vert', 'in_normal'), (matrices, '16f/i', 'in_modelView')])
+            buffers = vbo, matrices
+        else:
+            vao = self.ctx.simple_vertex_array(program, vbo, 'in_vert', 'in_normal')
+            buffers = vbo,
+        entry = self.vertex_arrays[key] = vao, buffers
+        while len(self.vertex_arrays) > self.max_vertex_arrays:
+            _, (old_vao, old_buffers) = self.vertex_arrays.popitem(last=False)
+            old_vao.release()
+            for buffer in old_buffers:
+                buffer.release()
+        return entry
+
+    def quad(self, program: moderngl.Program) -> moderngl.VertexArray:
+        """Vertex array without buffers for shaders/quad.vert"""
+        if program.glo not in self.quads:
+            self.quads[program.glo] = self.ctx.vertex_array(program, [])
+        return self.quads[program.glo]
+
+    def framebuffer(self, size: Size, components: int = 4, texture: bool = False) -> moderngl.Framebuffer:
+        key = tuple(size), components, texture
+        if key in self.framebuffers:
+            self.framebuffers.move_to_end(key)
+            return self.framebuffers[key]
+        fbo = self.framebuffers[key] = create_fbo(self.ctx, size, components, texture)
+        while len(self.framebuffers) > self.max_framebuffers:
+            _, old = self.framebuffers.popitem(last=False)
+            for attachment in old.color_attachments + (old.depth_attachment,):
+                attachment.release()
+            old.release()
+        return fbo
+
+    def pixel_buffer_pair(self, owner, size: int) -> Tuple[moderngl.Buffer, moderngl.Buffer]:
+        """Two pixel buffer objects of size bytes for the owner alone, since
+        they hold frames between calls. Least recently used pairs are
+        released, owners notice by getting a new pair. The pool only keeps
+        the id of the owner, its pairs are released once it is collected."""
+        while self._dead_owners:
+            self._release_owner(self._dead_owners.pop())
+        key = id(owner), size
+        if id(owner) not in self._owners:
+            self._owners.add(id(owner))
+            # list.append is atomic, finalizers run on whatever thread collects
+            weakref.finalize(owner, self._dead_owners.append, id(owner))
+        if key in self.pixel_buffers:
+            self.pixel_buffers.move_to_end(key)
+            return self.pixel_buffers[key]
+        pair = self.pixel_buffers[key] = self.ctx.buffer(reserve=size), self.ctx.buffer(reserve=size)
+        while len(self.pixel_buffers) > self.max_pixel_buffers:
+            _, old = self.pixel_buffers.popitem(last=False)
+            for buffer in old:
+                buffer.release()
+        return pair
+
+    def _release_owner(self, owner: int) -> None:
+        self._owners.discard(owner)
+        for key in [key for key in self.pixel_buffers if key[0] == owner]:
+            for buffer in self.pixel_buffers.pop(key):
+                buffer.release()
+
+    def release(self) -> None:
+        for vao, buffers in self.vertex_arrays.values():
+            vao.release()
+            for buffer in buffers:
+                buffer.release()
+        for fbo in self.framebuffers.values():
+            for attachment in fbo.color_attachments + (fbo.depth_attachment,):
+                attachment.release()
+            fbo.release()
+        for pair in self.pixel_buffers.values():
+            for buffer in pair:
+                buffer.release()
+        for vao in self.quads.values():
+            vao.release()
+        for prog in self.programs.values():
+            prog.release()
+        self.vertex_arrays.clear()
+        self.quads.clear()
+        self.framebuffers.clear()
+        self.pixel_buffers.clear()
+        self.programs.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'programs': len(self.programs),
+            'vertex_arrays': len(self.vertex_arrays),
+            'framebuffers': len(self.framebuffers),
+            'pixel_buffers': 2 * len(self.pixel_buffers),
+        }
 
 
 class Renderer:
+    """Renders a mesh into a framebuffer. The GL resources are looked up in
+    the pool on every use, so renderers are cheap to create and the pool may
+    evict resources between frames."""
     def __init__(
-            self, ctx: moderngl.Context, size: Size, mesh: Mesh, projection: np.array, components=4):
+            self, ctx: moderngl.Context, size: Size, mesh: Mesh, projection: np.array, components=4,
+            pool: Optional[ResourcePool] = None, lod: bool = True):
         self.size = size
         self.projection = projection
+        self.mesh = mesh
+        # draws simplified meshes when they cover few pixels
+        self.lods = lod_chain(mesh) if lod else None
+        self.components = components
+        self.pool = pool or ResourcePool(ctx)
+        self.ctx = ctx
+        w, h = size
+        self.gray = np.empty((h, w), dtype=np.uint8)
+        self._pixel_buffers = None
+        self._in_flight = None  # ((mode, scene), pixel buffer) drawn ahead by _read_back()
 
-        self.prog = ctx.program(
-            vertex_shader=Path('shaders/simple.vert').read_text(),
-            fragment_shader=Path('shaders/simple.frag').read_text())
+    @property
+    def prog(self) -> moderngl.Program:
+        return self.pool.program(*SIMPLE)
 
-        #from ModernGL.ext.obj import Obj
-        #mesh = Obj.open('meshes/cube.obj')
-        #vertex_data = mesh.pack('vx vy vz nx ny nz')
-        #self.vao = from_mesh(ctx, self.prog, mesh)
-        vertex_data = pack(mesh).astype('f4').tobytes()
-        self.vbo = ctx.buffer(vertex_data)
-        self.vao = ctx.simple_vertex_array(self.prog, self.vbo, 'in_vert', 'in_normal')
-        self.fbo = create_fbo(ctx, self.size, components)
-        self.fbo.use()
+    @property
+    def vao(self) -> moderngl.VertexArray:
+        return self.pool.vertex_array(self.prog, self.mesh)
 
-        self.ctx = ctx
+    @property
+    def fbo(self) -> moderngl.Framebuffer:
+        return self.pool.framebuffer(self.size, self.components)
+
+    def level(self, camera: np.array, size: Size) -> Mesh:
+        """The mesh to draw into size pixels"""
+        if self.lods is None:
+            return self.mesh
+        return self.lods.select(self.projection, camera, size)
 
     def render(self, camera: np.array, light1: np.array):
+        self.fbo.use()
+        self.ctx.clear()
+        self._draw(self.projection, camera, light1, self.size)
+
+    def _draw(self, projection: np.array, camera: np.array, light1: np.array, size: Size):
+        prog = self.prog
+        prog['u_light1'].write(light1.astype('f4'))
+        prog['u_ambient'].write(np.array(0.01).astype('f4'))
+        prog['u_projection'].write(projection.astype('f4'))
+        prog['u_modelView'].write(camera.astype('f4'))
+        self.pool.vertex_array(prog, self.level(camera, size)).render()
+
+    def _draw_gray(self, fbo: moderngl.Framebuffer, camera: np.array, light1: np.array):
+        fbo.use()
         self.ctx.clear()
+        # flip y so that rows are read back top row first, which also flips
+        # the winding of the faces
+        self.ctx.front_face = 'cw'
+        self._draw(np.multiply(self.projection, [1, -1, 1, 1]), camera, light1, fbo.size)
+        self.ctx.front_face = 'ccw'
+
+    def _draw_luminance(self, scene: Scene, pixel_buffer: moderngl.Buffer):
+        """Draws into a single channel framebuffer and starts copying it into
+        the pixel buffer without waiting for it"""
+        fbo = self.pool.framebuffer(self.size, 1)
+        self._draw_gray(fbo, *scene)
+        fbo.read_into(pixel_buffer, components=1, dtype='f1', alignment=1)
+
+    def _draw_cells(self, scene: Scene, pixel_buffer: moderngl.Buffer, levels: int, gamma: float, oversample: int):
+        """Draws oversample x oversample pixels per cell, then a second pass
+        averages every cell and writes its ramp index"""
+        w, h = self.size
+        oversampled = self.pool.framebuffer((w * oversample, h * oversample), 1, texture=True)
+        self._draw_gray(oversampled, *scene)
+
+        fbo = self.pool.framebuffer(self.size, 1)
+        fbo.use()
+        self.ctx.clear()
+        prog = self.pool.program(*QUANTIZE)
+        oversampled.color_attachments[0].use(0)
+        prog['u_gray'].value = 0
+        prog['u_oversample'].value = oversample
+        prog['u_levels'].value = levels
+        prog['u_gamma'].value = gamma
+        prog['u_eps'].value = ascii.EPS
+        self.pool.quad(prog).render(vertices=3)
+        fbo.read_into(pixel_buffer, components=1, dtype='f1', alignment=1)
+
+    def _read_back(self, draw: Callable[[Scene, moderngl.Buffer], None], mode, scene: Scene, prefetch: Optional[Scene]) -> np.array:
+        """Returns what draw wrote for the scene. Frames are read back
+        asynchronously through two pixel buffers. With prefetch, the scene of
+        the next frame, that frame is drawn and its copy started before this
+        frame is waited for, and the next call only waits for the copy if
+        prefetch was right."""
+        pair = self.pool.pixel_buffer_pair(self, self.gray.nbytes)
+        if pair is not self._pixel_buffers:
+            self._pixel_buffers, self._in_flight = pair, None
+
+        key = mode, scene[0].tobytes() + scene[1].tobytes()
+        with STAGE_SECONDS.labels('draw').time():
+            if self._in_flight is not None and self._in_flight[0] == key:
+                current = self._in_flight[1]
+            else:
+                current = pair[0]
+                draw(scene, current)
+            self._in_flight = None
+
+            if prefetch is not None:
+                following = pair[1] if current is pair[0] else pair[0]
+                draw(prefetch, following)
+                self._in_flight = (mode, prefetch[0].tobytes() + prefetch[1].tobytes()), following
+
+        with STAGE_SECONDS.labels('readback').time():
+            current.read_into(self.gray)
+        return self.gray
+
+    def luminance(self, camera: np.array, light1: np.array, prefetch: Optional[Scene] = None) -> np.array:
+        """Renders and returns the gray level of every pixel as uint8, top row
+        first, in a buffer that is reused by the next call. prefetch is the
+        (camera, light1) of the next frame, see _read_back."""
+        return self._read_back(self._draw_luminance, None, (camera, light1), prefetch)
+
+    def cells(
+            self, camera: np.array, light1: np.array, levels: int, gamma: float = 1.0, oversample: int = 4,
+            prefetch: Optional[Scene] = None) -> np.array:
+        """Renders oversampled and returns the index into a ramp of levels
+        characters of every pixel, averaged on the GPU. Like luminance()
+        otherwise, only one byte per character is read back."""
+        mode = levels, gamma, oversample
+        draw = functools.partial(self._draw_cells, levels=levels, gamma=gamma, oversample=oversample)
+        return self._read_back(draw, mode, (camera, light1), prefetch)
+
+    def luminance_batch(self, cameras: List[np.array], light1: np.array) -> np.array:
+        """Renders one frame per camera and returns their gray levels as a
+        (frames, h, w) uint8 array, top row first. Up to MAX_BATCH frames are
+        drawn instanced into a vertical atlas with a single clear, one set of
+        uniforms and one draw call, then read back in one transfer."""
+        w, h = self.size
+        limit = min(MAX_BATCH, self.ctx.info['GL_MAX_RENDERBUFFER_SIZE'] // h)
+        frames = np.empty((len(cameras), h, w), dtype=np.uint8)
+        for start in range(0, len(cameras), limit):
+            batch = cameras[start:start + limit]
+            fbo = self.pool.framebuffer((w, h * len(batch)), 1)
+            prog = self.pool.program(*BATCH)
+            # one mesh for the whole batch, detailed enough for every frame
+            mesh = self.mesh if self.lods is None else self.lods.for_coverage(
+                max(self.lods.coverage(self.projection, camera, self.size) for camera in batch))
+            vao, matrices = self.pool.instanced_vertex_array(prog, mesh, MAX_BATCH)
+            matrices.write(np.array(batch, dtype='f4').tobytes())
 
-        self.prog['u_light1'].write(light1.astype('f4'))
-        self.prog['u_ambient'].write(np.array(0.01).astype('f4'))
-        self.prog['u_projection'].write(self.projection.astype('f4'))
-        self.prog['u_modelView'].write(camera.astype('f4'))
-        self.vao.render()
+            fbo.use()
+            self.ctx.clear()
+            prog['u_light1'].write(light1.astype('f4'))
+            prog['u_ambient'].write(np.array(0.01).astype('f4'))
+            prog['u_projection'].write(np.multiply(self.projection, [1, -1, 1, 1]).astype('f4'))
+            prog['u_batch'].value = len(batch)
+            # each frame is clipped to its band, see shaders/batch.vert
+            self.ctx.enable_direct(GL_CLIP_DISTANCE0)
+            self.ctx.enable_direct(GL_CLIP_DISTANCE0 + 1)
+            self.ctx.front_face = 'cw'
+            vao.render(instances=len(batch))
+            self.ctx.front_face = 'ccw'
+            self.ctx.disable_direct(GL_CLIP_DISTANCE0)
+            self.ctx.disable_direct(GL_CLIP_DISTANCE0 + 1)
+            fbo.read_into(frames[start:start + len(batch)], components=1, dtype='f1', alignment=1)
+        return frames
 
     def snapshot(self, components=4):
         """Returns current fbo as an image"""
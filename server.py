@@ -1,75 +1,45 @@
-from itertools import count
-from pathlib import Path
-import sys
 import time
 
-from flask import Flask, request, Response
-import moderngl
-import numpy as np
-from pyrr import Matrix44
+from flask import Flask, abort, jsonify, request, Response
 
-import ascii
-from mesh import Mesh
-from mesh_io import load_obj
-from renderer import Renderer  # opengl
-import numgl
-from torus import torus
+from broadcast import Broadcaster
+from compression import compression_stats, stream_compressor
+from imagecache import cache_headers, image_cache, image_etag, not_modified
+import metrics
+from metrics import ACTIVE_STREAMS, startup
+from pacing import Connection, Pacer
+from stream import (
+    EPOCH, baked, byte_stats, encode_frame, frame_cache, frame_encoder, image_params, pacing_ladder, render_image,
+    stream_params, torus_producer)
+from warmup import warm_worker
 
 
 app = Flask(__name__)
 
+broadcaster = Broadcaster(EPOCH)
 
-def parse_resolution(s: str):
-    return tuple(int(d) for d in s.split('x'))
+# gunicorn imports the app in each worker before it accepts connections, a
+# failed warm-up is logged and fails the boot of the worker
+warm_worker()
 
 
-def create_context():
-    # Re-use context objects as a workaround for this issue
-    # https://github.com/moderngl/moderngl/issues/226
-    if create_context.cache:
-        return create_context.cache
-
-    ctx = moderngl.create_standalone_context(
-        libgl='libGL.so.1',
-        libx11='libX11.so.6')
-    ctx.enable(moderngl.DEPTH_TEST | moderngl.CULL_FACE | moderngl.BLEND)
-    create_context.cache = ctx
-    return ctx
-create_context.cache = None  # type: ignore[attr-defined]
-
-
-def scroller(line: bytes, text: str, t, w=1) -> bytes:
-    work = list(line)
-    data = text.encode()
-    start = int(t * w) - len(data)
-    n = len(work) + len(data)
-    for i, char in enumerate(data):
-        j = (start + i) % n
-        if j >= 0 and j < len(work):
-            work[j] = char
-    return bytes(work)
+def bad_request(e: ValueError) -> Response:
+    return Response('{}\n'.format(e), status=400, mimetype='text/plain')
 
 
 @app.route('/torus.png')
 def torus_image():
-    mesh = torus(1, 0.5, 12, 32)
-    w, h = parse_resolution(request.args.get('resolution', '80x50'))
-    aspect = float(request.args.get('aspect', '1'))
-    t = float(request.args.get('t', 0))
-    
-    light1 = numgl.normalized(np.array([0, 1, 1]))
-    angular_velocity = np.array([1.7, 2, 0])
-    projection = Matrix44.perspective_projection(60.0, aspect * w / h, 0.1, 10.0)
-    camera = Matrix44.from_translation(np.array([0, 0, -3])) * Matrix44.from_eulers(t * angular_velocity)
-
-    with create_context() as ctx:
-        renderer = Renderer(ctx, (w, h), mesh, projection=projection)
-        renderer.render(camera, light1)
-        image = renderer.snapshot()        
-        from io import BytesIO
-        with BytesIO() as f:
-            image.save(f, 'png')
-            return Response(f.getvalue(), mimetype='image/png')
+    try:
+        params = image_params(request.args)
+    except ValueError as e:
+        return bad_request(e)
+    etag = image_etag(params)
+    if not_modified(request.headers.get('If-None-Match', ''), etag):
+        image_cache.count_not_modified()
+        return Response(status=304, headers=cache_headers(etag))
+    png = image_cache.get_or_render(etag, lambda: render_image(*params))
+    startup.frame_sent()
+    return Response(png, mimetype='image/png', headers=cache_headers(etag))
 
 
 @app.route('/torus')
@@ -77,37 +47,71 @@ def stream_torus():
     if 'curl' not in request.headers.get('User-Agent', 'unknown') and 'curl' not in request.args.get('user-agent', 'unknown'):
         return app.send_static_file('ubuntu.html')
 
-    mesh = torus(1, 0.5, 12, 32)
-    w, h = parse_resolution(request.args.get('resolution', '80x24'))
-    aspect = float(request.args.get('aspect', '0.5'))
-    fps = float(request.args.get('fps', 25))
-    fov = float(request.args.get('fov', 60))
-    d = float(request.args.get('d', 3.2))
-
-    light1 = numgl.normalized(np.array([0, 1, 1]))
-    angular_velocity = np.array([1.7, 2, 0])
-    projection = Matrix44.perspective_projection(fov, aspect * w / h, 0.1, 10.0)
+    try:
+        ladder = pacing_ladder(stream_params(request.args), request.args)
+    except ValueError as e:
+        return bad_request(e)
+    encoder = frame_encoder(request.args)
+    compressor = stream_compressor(request.headers.get('Accept-Encoding', ''))
+    connection = Connection(request.environ.get('gunicorn.socket'))
 
-    dt = 1 / fps
-    beginning = time.time()
     def frames():
-        with create_context() as ctx:
-            renderer = Renderer(ctx, (w, h), mesh, projection=projection)
-
-            for _ in count():
-                t = time.time() - beginning
-                theta = t * angular_velocity
-                rotation = Matrix44.from_z_rotation(theta[2]) * Matrix44.from_y_rotation(theta[1]) * Matrix44.from_x_rotation(theta[0])
-                camera = Matrix44.from_translation(np.array([0, 0, -d])) * rotation
-                renderer.render(camera, light1)
-                buffer = np.mean(renderer.snapshot2(), axis=-1)
-                lines = ascii.shade(buffer)
-                text = "resolution: {w}x{h}, fov: {fov:.2f}, fps: {fps:.2f}, d: {d:.2f}, by: vidstige 2020".format(
-                    w=w, h=h, fov=fov, fps=fps, d=d)
-                lines[-2] = scroller(lines[-2], text, t, w=-12)
-                yield b"\033[2J\033[1;1H" + b'\n'.join(lines) + b"\n"
-                duration = (time.time() - beginning) - t
-                if dt - duration > 0:
-                    time.sleep(dt - duration)
-
-    return Response(frames(), mimetype='text/plain;charset=UTF-8')
+        ACTIVE_STREAMS.inc()
+        try:
+            with Pacer(ladder) as pacer:
+                while True:
+                    params = pacer.params
+                    # slow clients always skip to the newest frame
+                    with broadcaster.subscribe(
+                            params, params.fps, lambda: torus_producer(params), max_lag=0) as subscription:
+                        for frame in subscription:
+                            data = encode_frame(encoder, frame, compressor)
+                            # resumes once the server has written the frame
+                            start = time.perf_counter()
+                            yield data
+                            if pacer.record(len(data), time.perf_counter() - start, connection.unsent()):
+                                break
+                        else:
+                            break
+            if compressor is not None:
+                yield compressor.finish()
+        finally:
+            ACTIVE_STREAMS.dec()
+
+    response = Response(frames(), mimetype='text/plain;charset=UTF-8')
+    response.vary.add('Accept-Encoding')
+    if compressor is not None:
+        response.content_encoding = compressor.encoding
+    return response
+
+
+@app.route('/stats')
+def stats():
+    return jsonify(
+        frame_cache=frame_cache.stats(),
+        baked=baked.stats(),
+        broadcast=broadcaster.stats(),
+        bytes={mode: s.stats() for mode, s in byte_stats.items()},
+        compression={encoding: s.stats() for encoding, s in compression_stats.items()},
+        images=image_cache.stats(),
+        startup=startup.stats())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/profile')
+def profile():
+    """Sampled stacks of this worker, only with PROFILING=1"""
+    if not metrics.PROFILING:
+        abort(404)
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), 60)
+    except ValueError as e:
+        return bad_request(e)
+    stacks = metrics.profile(seconds)
+    if stacks is None:
+        return Response('already profiling\n', status=409, mimetype='text/plain')
+    return Response(stacks, mimetype='text/plain')
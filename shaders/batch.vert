@@ -0,0 +1,26 @@
+#version 330
+// simple.vert for a batch of frames drawn instanced into a vertical atlas,
+// instance i has its own model view and is squeezed into band i
+uniform mat4 u_projection;
+uniform vec3 u_light1;
+uniform float u_ambient;
+uniform int u_batch;
+
+in vec3 in_vert;
+in vec3 in_normal;
+in mat4 in_modelView;
+
+out vec4 color;
+
+void main() {
+  vec4 position = u_projection * in_modelView * vec4(in_vert, 1.0);
+  // clip to the frame's own band before squeezing it
+  gl_ClipDistance[0] = position.w + position.y;
+  gl_ClipDistance[1] = position.w - position.y;
+  position.y = (position.y + position.w * float(2 * gl_InstanceID + 1)) / float(u_batch) - position.w;
+  gl_Position = position;
+
+  vec4 normal = transpose(inverse(in_modelView)) * vec4(in_normal, 0.0);
+  float gray = clamp(dot(normalize(u_light1), normalize(vec3(normal))), 0, 1) + u_ambient;
+  color = vec4(gray, gray, gray, 1.0);
+}
@@ -0,0 +1,22 @@
+#version 330
+// Averages the oversampled gray levels of a character cell and writes the
+// index into a ramp of u_levels characters, the way ascii.Shader does
+uniform sampler2D u_gray;
+uniform int u_oversample;
+uniform int u_levels;
+uniform float u_gamma;
+uniform float u_eps;
+
+out vec4 f_color;
+void main() {
+    ivec2 origin = ivec2(gl_FragCoord.xy) * u_oversample;
+    float sum = 0.0;
+    for (int y = 0; y < u_oversample; y++) {
+        for (int x = 0; x < u_oversample; x++) {
+            sum += texelFetch(u_gray, origin + ivec2(x, y), 0).r;
+        }
+    }
+    float gray = pow(sum / float(u_oversample * u_oversample), 1.0 / u_gamma);
+    int index = clamp(int((gray - u_eps) * float(u_levels)), 0, u_levels - 1);
+    f_color = vec4(float(index) / 255.0, 0.0, 0.0, 1.0);
+}
@@ -16,7 +16,7 @@ function main() {
     });
   }
 
-  var url = '/torus?user-agent=curl?fps=10';
+  var url = '/torus?user-agent=curl?fps=10&delta=0';
   fetch(url).then(response => {
       return consume(response.body.getReader());
   })
@@ -0,0 +1,319 @@
+"""Rendering of the torus animation, shared by the flask and asgi servers"""
+from io import BytesIO
+import math
+import os
+import time
+from typing import Callable, List, Mapping, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pyrr import Matrix44
+
+from archive import ArchiveDirectory
+import ascii
+from backends import BACKENDS, DEFAULT_BACKEND, get_backend
+from compression import StreamCompressor
+from delta import CLEAR, ByteStats, DeltaEncoder
+from framecache import FrameCache
+from metrics import FRAME_SECONDS, STAGE_SECONDS, WRITE_BYTES, startup
+import numgl
+from torus import torus
+
+
+# animation time is shared by all streams so that frames can be shared
+EPOCH = time.time()
+frame_cache = FrameCache()
+byte_stats = {'full': ByteStats(), 'delta': ByteStats()}
+
+# Pre-rendered loops written by bake.py
+baked = ArchiveDirectory(os.environ.get('BAKED', 'baked'))
+# The rotation about x and y in scene() both come full circle after 20 pi seconds
+LOOP_SECONDS = 20 * math.pi
+
+# Shared by all renderers so that the pooled vertex array is re-used
+TORUS = torus(1, 0.5, 12, 32)
+
+
+class StreamParams(NamedTuple):
+    resolution: Tuple[int, int]
+    aspect: float
+    fps: float
+    fov: float
+    d: float
+    ramp: bytes = ascii.SIMPLE
+    gamma: float = 1.0
+    backend: str = DEFAULT_BACKEND
+    oversample: int = 1
+
+
+RAMPS = {'simple': ascii.SIMPLE, 'long': ascii.LONG}
+MAX_OVERSAMPLE = 8
+
+# zlib level of each png encoder profile, -1 is the zlib default that PIL
+# uses and 0 stores the pixels uncompressed
+IMAGE_PROFILES = {'default': -1, 'fast': 1, 'none': 0}
+DEFAULT_IMAGE_PROFILE = os.environ.get('IMAGE_PROFILE', 'default')
+
+
+class ImageParams(NamedTuple):
+    """Everything /torus.png depends on, in the order of render_image()"""
+    resolution: Tuple[int, int]
+    aspect: float
+    t: float
+    backend: str = DEFAULT_BACKEND
+    profile: str = DEFAULT_IMAGE_PROFILE
+
+
+def parse_resolution(s: str) -> Tuple[int, int]:
+    size = tuple(int(d) for d in s.split('x'))
+    if len(size) != 2 or min(size) < 1:
+        raise ValueError('resolution must be WxH and at least 1x1')
+    return size
+
+
+def parse_ramp(s: str) -> bytes:
+    """A named ramp or the characters of a custom one"""
+    if s in RAMPS:
+        return RAMPS[s]
+    ramp = s.encode('ascii')
+    if len(ramp) < 2 or not all(32 <= c < 127 for c in ramp):
+        raise ValueError('ramp must be at least two printable characters')
+    return ramp
+
+
+def parse_backend(s: str) -> str:
+    if s not in BACKENDS:
+        raise ValueError('backend must be one of {}'.format(', '.join(BACKENDS)))
+    return s
+
+
+def parse_finite(s: str) -> float:
+    value = float(s)
+    if not math.isfinite(value):
+        raise ValueError('{} is not a finite number'.format(s))
+    # -0.0 renders the same as 0.0
+    return value + 0.0
+
+
+def parse_positive(s: str) -> float:
+    value = parse_finite(s)
+    if value <= 0:
+        raise ValueError('{} is not a positive number'.format(s))
+    return value
+
+
+def parse_profile(s: str) -> str:
+    if s not in IMAGE_PROFILES:
+        raise ValueError('profile must be one of {}'.format(', '.join(IMAGE_PROFILES)))
+    return s
+
+
+def parse_oversample(s: str) -> int:
+    oversample = int(s)
+    if not 1 <= oversample <= MAX_OVERSAMPLE:
+        raise ValueError('oversample must be between 1 and {}'.format(MAX_OVERSAMPLE))
+    return oversample
+
+
+def stream_params(args: Mapping[str, str]) -> StreamParams:
+    return StreamParams(
+        resolution=parse_resolution(args.get('resolution', '80x24')),
+        aspect=float(args.get('aspect', '0.5')),
+        fps=parse_positive(args.get('fps', '25')),
+        fov=float(args.get('fov', 60)),
+        d=float(args.get('d', 3.2)),
+        ramp=parse_ramp(args.get('ramp', 'simple')),
+        gamma=parse_positive(args.get('gamma', '1')),
+        backend=parse_backend(args.get('backend', DEFAULT_BACKEND)),
+        oversample=parse_oversample(args.get('oversample', '1')))
+
+
+def image_params(args: Mapping[str, str]) -> ImageParams:
+    """Normalized, so that equal images have equal parameters"""
+    return ImageParams(
+        resolution=parse_resolution(args.get('resolution', '80x50')),
+        aspect=parse_finite(args.get('aspect', '1')),
+        t=parse_finite(args.get('t', '0')),
+        backend=parse_backend(args.get('backend', DEFAULT_BACKEND)),
+        profile=parse_profile(args.get('profile', DEFAULT_IMAGE_PROFILE)))
+
+
+def pacing_ladder(params: StreamParams, args: Mapping[str, str]) -> List[StreamParams]:
+    """The requested parameters followed by cheaper ones, for adaptive=1
+    streams: halved frame rates down to min_fps, the simple ramp, then halved
+    resolutions down to min_resolution"""
+    ladder = [params]
+    if args.get('adaptive', '0') != '1':
+        return ladder
+    # a min_fps of 0 would halve the frame rate forever
+    min_fps = parse_positive(args.get('min_fps', str(params.fps / 4)))
+    min_w, min_h = parse_resolution(args.get('min_resolution', '{}x{}'.format(*params.resolution)))
+    current = params
+    while current.fps / 2 >= min_fps:
+        current = current._replace(fps=current.fps / 2)
+        ladder.append(current)
+    if current.ramp != ascii.SIMPLE:
+        current = current._replace(ramp=ascii.SIMPLE)
+        ladder.append(current)
+    while True:
+        w, h = current.resolution
+        smaller = max(w // 2, min_w), max(h // 2, min_h)
+        if smaller == current.resolution:
+            return ladder
+        current = current._replace(resolution=smaller)
+        ladder.append(current)
+
+
+def encode_frame(encoder: DeltaEncoder, frame: bytes, compressor: Optional[StreamCompressor] = None) -> bytes:
+    """Encodes a frame for one client and records it"""
+    with STAGE_SECONDS.labels('encode').time():
+        # baked frames are views of the archive until here
+        data = bytes(encoder.encode(frame))
+    if compressor is not None:
+        with STAGE_SECONDS.labels('compress').time():
+            data = compressor.compress(data)
+    WRITE_BYTES.observe(len(data))
+    startup.frame_sent()
+    return data
+
+
+def frame_encoder(args: Mapping[str, str]) -> DeltaEncoder:
+    """Per client encoder, delta=0 sends full frames"""
+    if args.get('delta', '1') == '0':
+        return DeltaEncoder(1, byte_stats['full'])
+    return DeltaEncoder(stats=byte_stats['delta'])
+
+
+def scroller(line: bytes, text: str, t, w=1) -> bytes:
+    work = list(line)
+    data = text.encode()
+    start = int(t * w) - len(data)
+    n = len(work) + len(data)
+    for i, char in enumerate(data):
+        j = (start + i) % n
+        if j >= 0 and j < len(work):
+            work[j] = char
+    return bytes(work)
+
+
+def render_image(
+        resolution: Tuple[int, int], aspect: float, t: float, backend: str = DEFAULT_BACKEND,
+        profile: str = DEFAULT_IMAGE_PROFILE) -> bytes:
+    """Renders a png, encoded with the zlib level of the profile"""
+    w, h = resolution
+
+    light1 = numgl.normalized(np.array([0, 1, 1]))
+    angular_velocity = np.array([1.7, 2, 0])
+    projection = Matrix44.perspective_projection(60.0, aspect * w / h, 0.1, 10.0)
+    camera = Matrix44.from_translation(np.array([0, 0, -3])) * Matrix44.from_eulers(t * angular_velocity)
+
+    backend = get_backend(backend)
+
+    def render():
+        renderer = backend.renderer((w, h), TORUS, projection)
+        renderer.render(camera, light1)
+        return renderer.snapshot()
+
+    # only the rendering needs the GL thread, not the encoding
+    image = backend.run(render)
+    with BytesIO() as f:
+        image.save(f, 'png', compress_level=IMAGE_PROFILES[profile])
+        return f.getvalue()
+
+
+def scene(params: StreamParams, t: float):
+    """Camera and light at time t"""
+    light1 = numgl.normalized(np.array([0, 1, 1]))
+    angular_velocity = np.array([1.7, 2, 0])
+    theta = t * angular_velocity
+    rotation = Matrix44.from_z_rotation(theta[2]) * Matrix44.from_y_rotation(theta[1]) * Matrix44.from_x_rotation(theta[0])
+    camera = Matrix44.from_translation(np.array([0, 0, -params.d])) * rotation
+    return camera, light1
+
+
+def render_frame(renderer, shader: ascii.Shader, params: StreamParams, frame: int) -> bytes:
+    # quantize time to the frame period, all streams with the same
+    # parameters then share the rendered frame
+    t = frame / params.fps
+    # the next frame is drawn while this one is read back
+    prefetch = scene(params, (frame + 1) / params.fps)
+    if params.oversample > 1:
+        # antialiased, the cells are averaged and quantized by the renderer
+        indices = renderer.cells(
+            *scene(params, t), len(params.ramp), params.gamma, params.oversample, prefetch=prefetch)
+        with STAGE_SECONDS.labels('shade').time():
+            lines = shader.lookup(indices)
+            return finish_frame(shader, lines, params, t)
+    gray = renderer.luminance(*scene(params, t), prefetch=prefetch)
+    with STAGE_SECONDS.labels('shade').time():
+        return finish_frame(shader, shader.shade(gray), params, t)
+
+
+def render_frames(renderer, shader: ascii.Shader, params: StreamParams, frames: range) -> List[bytes]:
+    """Renders consecutive frames in bulk, e.g. ahead of time. Frames are
+    drawn and read back in batches unless oversampled."""
+    if params.oversample > 1:
+        return [render_frame(renderer, shader, params, frame) for frame in frames]
+    scenes = [scene(params, frame / params.fps) for frame in frames]
+    _, light1 = scenes[0]
+    gray = renderer.luminance_batch([camera for camera, _ in scenes], light1)
+    return [finish_frame(shader, shader.shade(g), params, frame / params.fps) for g, frame in zip(gray, frames)]
+
+
+def finish_frame(shader: ascii.Shader, lines: np.array, params: StreamParams, t: float) -> bytes:
+    """Adds the scroller to the shaded lines and returns the frame"""
+    w, h = params.resolution
+    text = "resolution: {w}x{h}, fov: {fov:.2f}, fps: {fps:.2f}, d: {d:.2f}, by: vidstige 2020".format(
+        w=w, h=h, fov=params.fov, fps=params.fps, d=params.d)
+    lines[-2, :-1] = np.frombuffer(scroller(lines[-2, :-1].tobytes(), text, t, w=-12), dtype=np.uint8)
+    # the shader buffer is reused, frames outlive it in caches and streams
+    return shader.frame.tobytes()
+
+
+def stream_projection(params: StreamParams) -> Matrix44:
+    w, h = params.resolution
+    return Matrix44.perspective_projection(params.fov, params.aspect * w / h, 0.1, 10.0)
+
+
+def stream_shader(params: StreamParams) -> ascii.Shader:
+    return ascii.Shader(params.resolution, params.ramp, params.gamma, header=CLEAR)
+
+
+def bake_key(params: StreamParams) -> str:
+    """Identifies the frames of params, any backend renders the same frames"""
+    return repr(tuple(params._replace(backend=None)))
+
+
+def baked_producer(params: StreamParams) -> Optional[Callable[[int], memoryview]]:
+    """Returns frames of a baked loop if params were baked, else None"""
+    archive = baked.get(bake_key(params))
+    if archive is None:
+        return None
+
+    def produce(frame: int) -> memoryview:
+        return archive.frame(frame % len(archive))
+    return produce
+
+
+def torus_producer(params: StreamParams) -> Callable[[int], bytes]:
+    """Returns the render function for a broadcast channel, serving baked
+    frames when there are any"""
+    produce = baked_producer(params)
+    if produce is not None:
+        return produce
+
+    shader = stream_shader(params)
+    backend = get_backend(params.backend)
+    renderer = None
+
+    def render(frame: int) -> bytes:
+        nonlocal renderer
+        if renderer is None:
+            renderer = backend.renderer(params.resolution, TORUS, stream_projection(params))
+        return render_frame(renderer, shader, params, frame)
+
+    def produce(frame: int) -> bytes:
+        def miss() -> bytes:
+            with FRAME_SECONDS.time():
+                return backend.run(render, frame)
+        return frame_cache.get_or_render((params, frame), miss)
+    return produce
@@ -0,0 +1,63 @@
+"""Warm-up of server workers before they accept traffic.
+
+warm() creates the GL context, compiles the shader programs, simplifies the
+torus and renders frames and an image with every warmed backend, so that
+the first requests do not pay for any of it. Set WARMUP=0 to skip it and
+WARM_BACKENDS to a comma separated list to warm other backends than the
+default one. See SHADER_CACHE in backends.py for keeping compiled shaders
+across restarts. A failed warm-up is logged and fails the start of the
+worker, the backends it could not prepare would fail requests too."""
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable
+
+from backends import DEFAULT_BACKEND, get_backend
+from lod import lod_chain
+from metrics import startup
+from stream import (
+    TORUS, StreamParams, render_frame, render_frames, render_image, stream_params, stream_projection, stream_shader)
+
+logger = logging.getLogger(__name__)
+
+WARMUP = os.environ.get('WARMUP', '1') != '0'
+WARM_BACKENDS = [name for name in os.environ.get('WARM_BACKENDS', DEFAULT_BACKEND).split(',') if name]
+
+
+def first_frames(backend, params: StreamParams) -> None:
+    """Renders the way streams do, one frame, a batch and oversampled"""
+    renderer = backend.renderer(params.resolution, TORUS, stream_projection(params))
+    shader = stream_shader(params)
+    render_frame(renderer, shader, params, 0)
+    render_frames(renderer, shader, params, range(2))
+    oversampled = params._replace(oversample=4)
+    render_frame(renderer, stream_shader(oversampled), oversampled, 0)
+
+
+def warm(backends: Iterable[str] = WARM_BACKENDS) -> Dict[str, float]:
+    """Prepares the backends and returns the seconds of every step"""
+    steps = {}  # type: Dict[str, float]
+
+    def step(name: str, fn: Callable, *args) -> None:
+        start = time.perf_counter()
+        fn(*args)
+        steps[name] = time.perf_counter() - start
+
+    step('meshes', lod_chain(TORUS).build)
+    for name in backends:
+        backend = get_backend(name)
+        step(name + '.context', backend.run, lambda: None)
+        step(name + '.programs', backend.compile_programs)
+        step(name + '.frames', backend.run, first_frames, backend, stream_params({'backend': name}))
+        step(name + '.image', render_image, (80, 50), 1.0, 0.0, name)
+    return steps
+
+
+def warm_worker() -> None:
+    """Warms this worker unless WARMUP=0 and records how long it took"""
+    try:
+        steps = warm() if WARMUP else {}
+    except Exception:
+        logger.exception('warm-up of worker %d failed, set WARMUP=0 to start without it', os.getpid())
+        raise
+    startup.warmed(steps)